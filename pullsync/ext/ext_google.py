@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+import threading
 
 from cement.core import handler, hook
 import httplib2
@@ -28,6 +29,7 @@ class GoogleHandler(handler.CementBaseHandler):
         self.scopes = self.Meta.scopes
         self.app.extend('google', self)
         self._http = None
+        self._auth_lock = threading.Lock()
 
     @property
     def client_secrets(self):
@@ -51,10 +53,11 @@ class GoogleHandler(handler.CementBaseHandler):
         )
 
 
-    @property
-    def client(self):
-        if not self._http:
-            http_client = httplib2.Http()
+    def ensure_credentials(self):
+        # Runs the interactive authorisation flow when there are no valid
+        # stored credentials.  The lock stops threads that need a client at
+        # the same time from each starting the flow.
+        with self._auth_lock:
             credentials = self.credential_store.get()
             if not credentials or credentials.invalid:
                 self.app.log.debug('No valid credentials, authorizing...')
@@ -66,10 +69,26 @@ class GoogleHandler(handler.CementBaseHandler):
                     redirect_url="urn:ietf:wg:oauth:2.0:oob",
                 )
                 tools.run_flow(flow, self.credential_store, self.app.pargs)
-            self.credential_store.get().authorize(http_client)
+                credentials = self.credential_store.get()
+        return credentials
+
+    @property
+    def client(self):
+        if not self._http:
+            http_client = httplib2.Http()
+            self.ensure_credentials().authorize(http_client)
             self._http = http_client
         return self._http
 
+    def new_client(self):
+        # httplib2 clients can't be shared between threads so each thread
+        # making requests authorises its own with the stored credentials.
+        # These are normally stored by the main thread's client before any
+        # worker starts, so the flow only runs here if they were revoked.
+        http_client = httplib2.Http()
+        self.ensure_credentials().authorize(http_client)
+        return http_client
+
     def add_scope(self, scope):
         if scope not in self.scopes:
             self.scopes.append(scope)
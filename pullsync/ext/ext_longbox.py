@@ -1,15 +1,22 @@
+import base64
 from datetime import timedelta
+import hashlib
 import io
+import itertools
 import json
 import os
 import re
+import shutil
+import stat
+import threading
 import time
 
 import apiclient
-from apiclient.discovery import build
+from apiclient.discovery import build, build_from_document
 from cement.core import controller, handler, hook, interface
 from dateutil.parser import parse as parse_date
 from Levenshtein import distance
+import xdg.BaseDirectory
 
 from pullsync.ext import interfaces
 
@@ -31,12 +38,145 @@ def with_backoff(original_function):
     return retry_with_backoff
 
 
+# Longbox objects are stored as comics/<id & 0xff>/<id >> 8 & 0xff>/<id>/
+OBJECT_NAME = re.compile(r'^comics/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]+)/.')
+# Fields of each object kept by scan --index
+INDEX_FIELDS = (
+    'nextPageToken,'
+    'items(bucket,name,contentType,size,md5Hash,generation,updated)')
+# Storage v1 discovery document shipped with the package
+DISCOVERY_DOCUMENT = os.path.join(
+    os.path.dirname(__file__), 'data', 'storage_v1.json')
+# Most uploads kept in the log between index updates
+UPLOAD_LOG_SIZE = 10000
+
+
+class ResumableDownload(apiclient.http.MediaIoBaseDownload):
+    # Continues a download after the offset bytes already written to fd
+    def __init__(self, fd, request, offset=0, **kwargs):
+        super(ResumableDownload, self).__init__(fd, request, **kwargs)
+        self._progress = offset
+
+
+class AdaptiveDownload(ResumableDownload):
+    # Sizes each chunk from the throughput of the last one so a chunk
+    # takes about chunk_seconds, changing by at most a factor of two at a
+    # time and staying within the given bounds
+    def __init__(self, fd, request, min_chunksize, max_chunksize,
+                 chunk_seconds=2.0, **kwargs):
+        super(AdaptiveDownload, self).__init__(fd, request, **kwargs)
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.chunk_seconds = chunk_seconds
+        self._chunksize = self._bounded(self._chunksize)
+        self.received = 0
+        self.elapsed = 0.0
+
+    def _bounded(self, chunksize):
+        return int(max(self.min_chunksize, min(self.max_chunksize, chunksize)))
+
+    def next_chunk(self, **kwargs):
+        progress = self._progress
+        started = time.time()
+        result = super(AdaptiveDownload, self).next_chunk(**kwargs)
+        elapsed = time.time() - started
+        received = self._progress - progress
+        self.received += received
+        self.elapsed += elapsed
+        if received and elapsed > 0:
+            target = received / elapsed * self.chunk_seconds
+            self._chunksize = self._bounded(max(
+                self._chunksize / 2, min(self._chunksize * 2, target)))
+        return result
+
+
+class ContentIndex(object):
+    # Local copies of longbox files by pull id.  A copy is only trusted
+    # while its size and mtime are unchanged and the longbox object still
+    # has the same md5.  Copies are tracked by path, so a file renamed or
+    # moved outside of pullsync is no longer found.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as index_file:
+                self.entries = json.load(index_file)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        index_tmp = self.path + '.tmp'
+        with open(index_tmp, 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.rename(index_tmp, self.path)
+
+    def add(self, pull_id, path, item_detail):
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(str(pull_id))
+            if not entry or entry['md5'] != item_detail.get('md5Hash'):
+                entry = self.entries[str(pull_id)] = {
+                    'size': int(item_detail['size']),
+                    'md5': item_detail.get('md5Hash'),
+                    'files': {},
+                }
+            entry['files'][path] = os.path.getmtime(path)
+            self.save()
+
+    @staticmethod
+    def _unchanged(path, size, mtime):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime == mtime
+
+    def find(self, pull_id, item_detail):
+        with self.lock:
+            entry = self.entries.get(str(pull_id))
+            if not entry:
+                return None
+            files = {}
+            if (entry['md5'] == item_detail.get('md5Hash') and
+                    entry['size'] == int(item_detail['size'])):
+                files = dict(
+                    (path, mtime) for path, mtime in entry['files'].items()
+                    if self._unchanged(path, entry['size'], mtime))
+            if files != entry['files']:
+                entry['files'] = files
+                if not files:
+                    del self.entries[str(pull_id)]
+                self.save()
+            for path in sorted(files):
+                return path
+
+
 class Longbox(controller.CementBaseController):
     class Meta:
         interface = interfaces.DataInterface
         label = 'longbox'
         config_defaults = {
             'bucket': 'long-box',
+            # Bounds for the size of each download request, which is
+            # adjusted so a request takes about chunk_seconds
+            'min_chunk_size': 256 * 1024,
+            'max_chunk_size': 64 * 1024 * 1024,
+            'chunk_seconds': 2.0,
+            # Downloaded files are also linked into cache_dir when set so
+            # they can be reused after being removed from a sync directory
+            'cache_dir': '',
+            # Bytes kept in cache_dir, the oldest files are removed past
+            # this.  0 for no limit.
+            'cache_max_size': 10 * 1024 * 1024 * 1024,
+            # Days between full listings for scan --index, kept below the
+            # week gs:file entries are cached for
+            'index_max_age': 6,
+            # Local copy of the storage v1 discovery document, used instead
+            # of fetching it when the client is built.  Empty to fetch it.
+            'discovery_document': DISCOVERY_DOCUMENT,
+            # Seconds to remember that a pull has no files in the longbox,
+            # 0 to always check
+            'miss_ttl': 3600,
             }
 
     def _setup(self, app):
@@ -45,98 +185,397 @@ class Longbox(controller.CementBaseController):
         self.app.extend('longbox', self)
         # _http can be used to insert a HTTP Mock for testing
         self._http = None
+        self._local = threading.local()
+        self._main_thread = threading.current_thread()
+        self._discovery = None
+        self._discovery_lock = threading.Lock()
+        self.content_index = ContentIndex(os.path.join(
+            xdg.BaseDirectory.save_data_path(self.app._meta.label),
+            'content_index.json'))
 
     def file_detail(self, pull_id):
-        if self.app.redis.client.sismember('gs:seen', pull_id):
-            file_detail = self.app.redis.client.get('gs:file:%d' % pull_id)
-            if not file_detail:
-                self.app.redis.client.srem('gs:seen', pull_id)
+        return self.file_details([pull_id]).get(pull_id)
+
+    def file_details(self, pull_ids):
+        # Looks up the cached files for many pulls in one round trip.  Pulls
+        # without cached files are left out of the result.
+        pull_ids = [int(pull_id) for pull_id in pull_ids]
+        if not pull_ids:
+            return {}
+        with self.app.redis.pipeline() as pipe:
+            for pull_id in pull_ids:
+                pipe.sismember('gs:seen', pull_id)
+                pipe.get('gs:file:%d' % pull_id)
+            results = pipe.execute()
+        details = {}
+        expired = []
+        for pull_id, seen, file_detail in zip(
+                pull_ids, results[::2], results[1::2]):
+            if not seen:
+                continue
+            if file_detail:
+                details[pull_id] = json.loads(file_detail)
             else:
-                return json.loads(file_detail)
+                expired.append(pull_id)
+        if expired:
+            self.app.redis.client.srem('gs:seen', *expired)
+        return details
+
+    @property
+    def http(self):
+        # Threads other than the main one authorise their own client as
+        # httplib2 clients can't be shared between threads
+        if self._http:
+            return self._http
+        if threading.current_thread() is self._main_thread:
+            return self.app.google.client
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.app.google.new_client()
+        return self._local.http
+
+    @property
+    def discovery_document(self):
+        # Parsed once and shared by every thread
+        path = self.app.config.get(
+            self._meta.config_section, 'discovery_document')
+        if not path:
+            return None
+        with self._discovery_lock:
+            if not self._discovery:
+                with open(os.path.expanduser(path)) as discovery:
+                    self._discovery = json.load(discovery)
+        return self._discovery
 
     @property
     def client(self):
-        if not self._http:
-            self._http = self.app.google.client
-        return build('storage', 'v1', http=self._http)
+        # The storage service is built once for each thread's http client
+        http = self.http
+        if getattr(self._local, 'service_http', None) is not http:
+            document = self.discovery_document
+            if document:
+                self._local.service = build_from_document(document, http=http)
+            else:
+                self._local.service = build('storage', 'v1', http=http)
+            self._local.service_http = http
+        return self._local.service
 
-    @with_backoff
-    def check_prefix(self, pull_id):
-        file_detail = None
-        prefix = 'comics/%02x/%02x/%x' % (
+    def object_prefix(self, pull_id):
+        return 'comics/%02x/%02x/%x' % (
             pull_id & 0xff,
             (pull_id & 0xff00) >> 8,
             pull_id
         )
+
+    def forget_miss(self, pull_id):
+        self.app.redis.client.delete('gs:miss:%d' % pull_id)
+
+    def check_prefix(self, pull_id):
         file_detail = self.file_detail(pull_id)
         if not file_detail:
-            request = self.client.objects().list(
-                bucket=self.app.config.get(
-                    self._meta.config_section, 'bucket'),
-                prefix=prefix)
-            response = request.execute()
-            if 'items' in response:
-                self.app.log.debug('Files found for prefix %s' % prefix)
-                file_detail = response['items']
-                self.app.redis.client.sadd('gs:seen', pull_id)
+            file_detail = self.list_prefix(pull_id)
+        return file_detail
+
+    def list_prefix(self, pull_id):
+        # Goes to the bucket for a pull with no cached files
+        prefix = self.object_prefix(pull_id)
+        if self.app.redis.client.exists('gs:miss:%d' % pull_id):
+            self.app.log.debug('No files cached for prefix %s' % prefix)
+            return None
+        file_detail = None
+        request = self.client.objects().list(
+            bucket=self.app.config.get(
+                self._meta.config_section, 'bucket'),
+            prefix=prefix)
+        response = self._execute(request)
+        if 'items' in response:
+            self.app.log.debug('Files found for prefix %s' % prefix)
+            file_detail = response['items']
+            self.app.redis.client.sadd('gs:seen', pull_id)
+            self.app.redis.client.setex(
+                'gs:file:%d' % pull_id,
+                timedelta(7),
+                json.dumps(file_detail),
+            )
+        else:
+            miss_ttl = int(self.app.config.get(
+                self._meta.config_section, 'miss_ttl'))
+            if miss_ttl > 0:
                 self.app.redis.client.setex(
+                    'gs:miss:%d' % pull_id, miss_ttl, 1)
+        return file_detail
+
+    def iter_prefixes(self, pull_details, size=100):
+        # Pairs each pull with its files, resolving cached files a batch
+        # at a time and only listing the bucket for the rest
+        pull_details = iter(pull_details)
+        while True:
+            batch = list(itertools.islice(pull_details, size))
+            if not batch:
+                break
+            cached = self.file_details(
+                pull_detail['id'] for pull_detail in batch)
+            for pull_detail in batch:
+                pull_id = int(pull_detail['id'])
+                yield pull_detail, (
+                    cached.get(pull_id) or self.list_prefix(pull_id))
+
+    @with_backoff
+    def _execute(self, request):
+        return request.execute()
+
+    def list_objects(self, prefix='comics/', page_size=1000):
+        objects = self.client.objects()
+        request = objects.list(
+            bucket=self.app.config.get(self._meta.config_section, 'bucket'),
+            prefix=prefix,
+            fields=INDEX_FIELDS,
+            maxResults=page_size,
+        )
+        while request is not None:
+            response = self._execute(request)
+            for item in response.get('items', []):
+                yield item
+            request = objects.list_next(request, response)
+
+    def _store_index(self, index, removed):
+        with self.app.redis.pipeline() as pipe:
+            for pull_id, file_detail in index.items():
+                pipe.delete('gs:miss:%d' % pull_id)
+                pipe.sadd('gs:seen', pull_id)
+                pipe.setex(
                     'gs:file:%d' % pull_id,
                     timedelta(7),
                     json.dumps(file_detail),
                 )
-        return file_detail
+            for pull_id in removed:
+                pipe.srem('gs:seen', pull_id)
+                pipe.delete('gs:file:%d' % pull_id)
+            pipe.execute()
 
-    def fetch_file(self, item_detail, destination):
-        # Get Payload Data
-        req = self.client.objects().get_media(
-            bucket=item_detail['bucket'],
-            object=item_detail['name'],
-        )
+    def build_index(self):
+        # Lists every longbox object once and replaces the per pull
+        # gs:seen and gs:file:<id> entries check_prefix would create
+        started = time.time()
+        # Uploads logged before the listing started will be in it
+        logged = self.app.redis.client.llen('gs:uploads')
+        index = {}
+        for item in self.list_objects():
+            match = OBJECT_NAME.match(item['name'])
+            if match:
+                index.setdefault(int(match.group(1), 16), []).append(item)
+        stale = set(
+            int(pull_id) for pull_id in self.app.redis.client.smembers(
+                'gs:seen')) - set(index)
+        self._store_index(index, stale)
+        with self.app.redis.pipeline() as pipe:
+            pipe.ltrim('gs:uploads', logged, -1)
+            pipe.hset('gs:index', 'built', started)
+            pipe.execute()
+        self.app.log.info('Indexed %d pulls in longbox, removed %d' % (
+            len(index), len(stale)))
+        return index
+
+    def record_upload(self, pull_id):
+        # Uploads are logged so the next index update only lists them.
+        # Nothing drains the log until an index is built, and it is capped
+        # in case updates stop.
+        if not self.app.redis.client.hget('gs:index', 'built'):
+            return
+        with self.app.redis.pipeline() as pipe:
+            pipe.rpush('gs:uploads', pull_id)
+            pipe.ltrim('gs:uploads', -UPLOAD_LOG_SIZE, -1)
+            pipe.execute()
 
-        # The BytesIO object may be replaced with any io.Base instance.
-        fh = io.FileIO(destination.encode('utf-8'), 'w')
-        downloader = apiclient.http.MediaIoBaseDownload(
-            fh, req, chunksize=1024*1024)
-        done = False
+    def update_index(self, rebuild=False):
+        # The bucket can't be listed by modification time, so between full
+        # listings only pulls from the upload log are listed again
+        built = self.app.redis.client.hget('gs:index', 'built')
+        max_age = timedelta(float(self.app.config.get(
+            self._meta.config_section, 'index_max_age'))).total_seconds()
+        if rebuild or not built or time.time() - float(built) > max_age:
+            return self.build_index()
+        with self.app.redis.pipeline() as pipe:
+            pipe.lrange('gs:uploads', 0, -1)
+            pipe.delete('gs:uploads')
+            uploads = pipe.execute()[0]
+        pull_ids = set(int(pull_id) for pull_id in uploads)
+        index = {}
         try:
-            while not done:
-                status, done = downloader.next_chunk()
-                if status:
-                    self.app.log.debug(
-                        'Download %02d%%.' % int(status.progress() * 100)
-                    )
-        except apiclient.errors.HttpError as error:
-            self.app.log.error('Error downloading file: %r' % error)
-            os.unlink(destination)
+            for pull_id in pull_ids:
+                items = list(self.list_objects(
+                    prefix=self.object_prefix(pull_id) + '/'))
+                if items:
+                    index[pull_id] = items
+        except Exception:
+            # Keep the log for the next update
+            self.app.redis.client.rpush('gs:uploads', *pull_ids)
+            raise
+        removed = pull_ids - set(index)
+        self._store_index(index, removed)
+        self.app.log.info('Updated %d pulls in longbox index, removed %d' % (
+            len(index), len(removed)))
+        return index
 
-    def refresh(self):
-        self.app.redis.delete('pulls:seen')
-        pipe = self.app.redis.pipeline()
-        for pull in self.app.pulldb.list_unread():
-            pipe.sadd('pulls:unread', pull['identifier'])
-        pipe.execute()
-        unseen_items = self.app.redis.sdiff('pulls:unread', 'gs:seen')
-        self.app.log.debug('%r - %r = %r' % (
-            self.app.redis.smembers('pulls:unread'),
-            self.app.redis.smembers('gs:seen'),
-            unseen_items))
-
-        cache = []
-
-        for pull_id in unseen_items:
-            pull = 'pull:%s' % pull_id
-            pull_id = int(pull_id)
-            pull_detail = self.app.redis.client.get(pull)
-            if pull_detail:
-                pull_detail = json.loads(pull_detail)
-            else:
-                print 'skipping %d' % pull_id
+    def verify_file(self, path, item_detail):
+        size = os.path.getsize(path)
+        if 'size' in item_detail and size != int(item_detail['size']):
+            self.app.log.error('Size mismatch for %r: %d != %s' % (
+                item_detail['name'], size, item_detail['size']))
+            return False
+        if 'md5Hash' in item_detail:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as downloaded:
+                for block in iter(lambda: downloaded.read(1024*1024), ''):
+                    md5.update(block)
+            md5_hash = base64.b64encode(md5.digest())
+            if md5_hash != item_detail['md5Hash']:
+                self.app.log.error('Checksum mismatch for %r: %s != %s' % (
+                    item_detail['name'], md5_hash, item_detail['md5Hash']))
+                return False
+        return True
+
+    def log_throughput(self, name, downloader):
+        rate = ''
+        if downloader.elapsed:
+            rate = ' (%.1f KiB/s)' % (
+                downloader.received / downloader.elapsed / 1024,)
+        self.app.log.info('Downloaded %d bytes of %r in %.1fs%s' % (
+            downloader.received, name, downloader.elapsed, rate))
+
+    def link_file(self, source, destination):
+        # Hard links are used where possible, falling back to a copy when
+        # the files are on different devices
+        partial = destination + '.part'
+        try:
+            os.link(source, partial)
+        except OSError:
+            shutil.copy2(source, partial)
+        os.rename(partial, destination)
+
+    def fetch_local(self, pull_id, item_detail, destination):
+        local_copy = self.content_index.find(pull_id, item_detail)
+        if not local_copy:
+            return False
+        self.app.log.info('Using local copy %r for %r' % (
+            local_copy, item_detail['name']))
+        try:
+            self.link_file(local_copy, destination)
+        except (IOError, OSError) as error:
+            self.app.log.warn('Unable to use local copy %r: %r' % (
+                local_copy, error))
+            return False
+        self.content_index.add(pull_id, destination, item_detail)
+        return True
+
+    def cache_file(self, pull_id, item_detail, destination):
+        self.content_index.add(pull_id, destination, item_detail)
+        cache_dir = self.app.config.get(self._meta.config_section, 'cache_dir')
+        if not cache_dir:
+            return
+        cache_path = os.path.join(
+            cache_dir.encode('utf-8'), os.path.basename(destination))
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            if not os.path.exists(cache_path):
+                self.link_file(destination, cache_path)
+            self.content_index.add(pull_id, cache_path, item_detail)
+            self.prune_cache(cache_dir, keep=cache_path)
+        except (IOError, OSError) as error:
+            self.app.log.warn('Unable to cache %r: %r' % (cache_path, error))
+
+    def prune_cache(self, cache_dir, keep=None):
+        # Removes the least recently downloaded files until cache_dir fits
+        # in cache_max_size.  Index entries for removed files are dropped
+        # the next time they are looked up.
+        max_size = int(self.app.config.get(
+            self._meta.config_section, 'cache_max_size'))
+        if max_size <= 0:
+            return
+        files = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                path_stat = os.stat(path)
+            except OSError:
                 continue
-            pull_matches = self.check_prefix(pull_id)
+            if stat.S_ISREG(path_stat.st_mode):
+                files.append((path_stat.st_mtime, path, path_stat.st_size))
+        total = sum(size for mtime, path, size in files)
+        for mtime, path, size in sorted(files):
+            if total <= max_size:
+                break
+            if path == keep:
+                continue
+            self.app.log.debug('Removing cached file %r' % path)
+            try:
+                os.unlink(path)
+            except OSError as error:
+                # Another download may have pruned it first
+                self.app.log.debug('Unable to remove %r: %r' % (path, error))
+                continue
+            total -= size
+
+    def fetch_file(self, item_detail, destination, pull_id=None):
+        # Files are downloaded to a .part file next to the destination and
+        # only renamed into place once verified, a partial file left by an
+        # interrupted download is resumed from where it stopped
+        destination = destination.encode('utf-8')
+        if pull_id and self.fetch_local(pull_id, item_detail, destination):
+            return True
+        partial = destination + '.part'
+        offset = 0
+        if os.path.exists(partial):
+            offset = os.path.getsize(partial)
+        if 'size' in item_detail and offset > int(item_detail['size']):
+            offset = 0
+        if offset:
+            self.app.log.info('Resuming %r from %d bytes' % (
+                item_detail['name'], offset))
+
+        if 'size' not in item_detail or offset < int(item_detail['size']):
+            # Get Payload Data
+            req = self.client.objects().get_media(
+                bucket=item_detail['bucket'],
+                object=item_detail['name'],
+            )
+            section = self._meta.config_section
+            fh = io.FileIO(partial, 'a' if offset else 'w')
+            downloader = AdaptiveDownload(
+                fh, req, offset=offset, chunksize=1024*1024,
+                min_chunksize=int(self.app.config.get(
+                    section, 'min_chunk_size')),
+                max_chunksize=int(self.app.config.get(
+                    section, 'max_chunk_size')),
+                chunk_seconds=float(self.app.config.get(
+                    section, 'chunk_seconds')),
+            )
+            done = False
+            try:
+                while not done:
+                    status, done = downloader.next_chunk()
+            except apiclient.errors.HttpError as error:
+                # The partial file is kept so the next attempt can resume
+                self.app.log.error('Error downloading file: %r' % error)
+                return False
+            finally:
+                fh.close()
+                self.log_throughput(item_detail['name'], downloader)
+
+        if not self.verify_file(partial, item_detail):
+            os.unlink(partial)
+            return False
+        os.rename(partial, destination)
+        if pull_id:
+            self.cache_file(pull_id, item_detail, destination)
+        return True
+
+    def refresh(self):
+        for pull_detail, pull_matches in self.iter_prefixes(
+                self.app.pulldb.list_unseen()):
             if pull_matches:
                 self.app.log.debug('File found for [%s] %s' % (
                     pull_detail['identifier'], pull_detail['name']))
-                cache.append([pull, pull_matches])
                 for item in pull_matches:
                     print item['name']
             else:
@@ -146,18 +585,17 @@ class Longbox(controller.CementBaseController):
 
     def scan(self, new=False):
         if new:
-            unread_items = self.app.pulldb.fetch_new()
+            # pull_new uses the same http client as the page fetcher
+            unread_items = list(self.app.pulldb.fetch_new())
         else:
             unread_items = self.app.pulldb.list_unread()
 
-        for pull_detail in unread_items:
-            pull_id = int(pull_detail['id'])
-            pull_matches = self.check_prefix(pull_id)
+        for pull_detail, pull_matches in self.iter_prefixes(unread_items):
             if pull_matches:
                 self.app.log.debug('File found for [%s] %s' % (
                     pull_detail['identifier'], pull_detail['name']))
                 if new:
-                    self.app.pulldb.pull_new(pull_id)
+                    self.app.pulldb.pull_new(int(pull_detail['id']))
                 for item in pull_matches:
                     print item['name']
             else:
@@ -180,11 +618,21 @@ class ScanController(controller.CementBaseController):
                 'action': 'store_true',
                 'help': 'Scan only new issues',
             }),
+            (['--index'], {
+                'action': 'store_true',
+                'help': 'Index every file in the longbox at once',
+            }),
+            (['--rebuild'], {
+                'action': 'store_true',
+                'help': 'List the whole longbox again when indexing',
+            }),
         ]
 
     @controller.expose(hide=True)
     def default(self):
-        if self.app.pargs.full or self.app.pargs.new:
+        if self.app.pargs.index:
+            self.app.longbox.update_index(rebuild=self.app.pargs.rebuild)
+        elif self.app.pargs.full or self.app.pargs.new:
             self.app.longbox.scan(new=self.app.pargs.new)
         else:
             self.app.longbox.refresh()
@@ -1,4 +1,7 @@
+import array
+import hashlib
 import json
+import multiprocessing
 import os
 import re
 import time
@@ -9,58 +12,276 @@ from Levenshtein import distance
 
 from pullsync.ext import interfaces
 
+# Substitutions applied to file and pull names before they are compared.
+# Each stage is a list of (pattern, replacement) pairs that are fused into
+# a single alternation and applied in one pass, so rules within a stage
+# must not depend on the output of each other.  Stages run in order.
+NORMALISE_RULES = [
+    [
+        # Remove the file extension
+        (r'.cb[rz]$', ''),
+        # tags in brackets can be stripped
+        (r'\([^)]+\)', ''),
+        (r'\[[^)]+\]', ''),
+        # Somtimes a random volume number slips in
+        (r'\bv\d+\b', ''),
+        # strip release annotations
+        (r'\bc2c\b', ''),
+    ],
+    [
+        # Some substitutions for known bad nameing
+        (r'^trinity of sin - (?:the )?phantom stranger', 'phantom stranger'),
+        (r'the ', ' '),
+        (r'2000ad', '2000 ad'),
+        (r'(abe sapien \d+) -.*', r'\g<1>'),
+        (r'(b.p.r.d. hell on earth \d+) -.*', r'\g<1>'),
+        (r'digital exclusives edition', ''),
+        (r'garth ennis\'?', ''),
+        (r'george romero\'?s', ''),
+        (r'(outcast) by kirkman & azaceta', r'\g<1>'),
+        (r'robin rises omega', r'robin rises'),
+        (r'by kirkman & azaceta', ''),
+    ],
+]
+
+# Normalise spaces and rewrite unicode half to 0.5
+SPACE_RULES = [
+    (r' +', ' '),
+    (u'\xbd', r'0.5'),
+]
+
+# Fixups applied to the trailing issue number
+ISSUE_RULES = [
+    [
+        # Remove random issue suffixes that Marvel seem to like
+        (r'([.\d]+)(?:\.now)$', r'\g<1>'),
+    ],
+    [
+        # Strip leading zeroes from issue number
+        (r'\b0+([.\d]+)$', r'\g<1>'),
+    ],
+]
+
+ISSUE_NUMBER = re.compile(r'(\d+|)$')
+NAME_TOKEN = re.compile(r'\w+')
+INFINITY = float('inf')
+
+def name_tokens(normalised, issue_number, prefix_length=3):
+    # Word prefixes of a normalised name, excluding the issue number
+    if issue_number:
+        normalised = normalised[:-len(issue_number)]
+    return set(
+        token[:prefix_length] for token in NAME_TOKEN.findall(normalised))
+
+
+class NameNormaliser(object):
+    def __init__(self, rules=NORMALISE_RULES):
+        self.stages = [self._compile_stage(stage) for stage in rules]
+        self.spaces = self._compile_stage(SPACE_RULES)
+        self.issue_stages = [
+            self._compile_stage(stage) for stage in ISSUE_RULES]
+        # Identifies the rule set so cached normalisations made with other
+        # rules are not reused
+        self.fingerprint = hashlib.sha1(json.dumps(
+            [rules, SPACE_RULES, ISSUE_RULES])).hexdigest()[:12]
+
+    def _compile_stage(self, rules):
+        if len(rules) == 1:
+            pattern, replacement = rules[0]
+            return re.compile(pattern), replacement
+        # Wrap each rule in a named group so the matching rule can be
+        # identified from match.lastgroup.  Rules are compiled separately
+        # as well so group references in the replacement can be expanded.
+        fused = u'|'.join(
+            u'(?P<r%d>%s)' % (index, pattern)
+            for index, (pattern, replacement) in enumerate(rules))
+        compiled = [
+            (re.compile(pattern), replacement)
+            for pattern, replacement in rules
+        ]
+
+        def substitute(match):
+            rule, replacement = compiled[int(match.lastgroup[1:])]
+            if '\\' not in replacement:
+                return replacement
+            return rule.match(match.group(0)).expand(replacement)
+
+        return re.compile(fused), substitute
+
+    def _apply(self, stages, name):
+        for pattern, replacement in stages:
+            name = pattern.sub(replacement, name)
+        return name
+
+    def normalise(self, original_name):
+        # lowercase and change space characters
+        normal = original_name.lower().replace('_', ' ').replace('+', ' ')
+        normal = self._apply(self.stages, normal)
+        normal = self._apply([self.spaces], normal).strip()
+        # Fixup issue numbers
+        normal = self._apply(self.issue_stages, normal)
+        # Try to identify the issue number
+        issue_number = ISSUE_NUMBER.search(normal).group(1)
+        return normal, issue_number
+
+    def normalise_many(self, names):
+        # Names are frequently repeated in a batch (the same pull list is
+        # compared against every candidate) so only normalise each once.
+        seen = {}
+        results = []
+        for name in names:
+            if name not in seen:
+                seen[name] = self.normalise(name)
+            results.append(seen[name])
+        return results
+
+
+# Matcher state for pool workers.  Set by the pool initializer so the pull
+# index is inherited by each worker once rather than sent with every task.
+_worker_state = {}
+
+
+def _init_worker(matcher, pulls, threshold, blocking):
+    _worker_state.update(
+        matcher=matcher, pulls=pulls, threshold=threshold, blocking=blocking)
+
+
+def _score_candidate(candidate):
+    return _worker_state['matcher'].score_candidate(
+        candidate, _worker_state['pulls'], _worker_state['threshold'],
+        blocking=_worker_state['blocking'])
+
+
+class PullIndex(object):
+    def __init__(self, entries):
+        # list of (pull, (normalised name, issue number)) tuples
+        self.entries = entries
+        # Block pulls by issue number and by name token so candidates are
+        # only scored against pulls that could plausibly match them
+        self.by_issue = {}
+        self.by_token = {}
+        for position, (pull, (normalised, issue)) in enumerate(entries):
+            self.by_issue.setdefault(issue, set()).add(position)
+            for token in name_tokens(normalised, issue):
+                self.by_token.setdefault(token, set()).add(position)
+
+    def plausible(self, normalised, issue):
+        # Every pull with the same issue number is scored, whatever its
+        # name, as punctuation and joined words ("x-men", "xmen") defeat
+        # token blocking.  A pull with the same issue number always beats
+        # one without, so tokens are only used when there are no such
+        # pulls.
+        same_issue = self.by_issue.get(issue)
+        if same_issue:
+            return sorted(same_issue)
+        sharing_token = set()
+        for token in name_tokens(normalised, issue):
+            sharing_token.update(self.by_token.get(token, ()))
+        return sorted(sharing_token)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ScoreMatrix(object):
+    def __init__(self, candidates, pulls):
+        self.candidates = candidates
+        self.pulls = pulls
+        self.shape = (len(candidates), len(pulls))
+        self.names = [None] * len(candidates)
+        # Row major candidate x pull scores.  Pairs that were never scored
+        # (pruned by blocking or over the threshold) are left at inf.
+        self.scores = array.array('d', [INFINITY]) * (
+            len(candidates) * len(pulls))
+        self.mismatch = array.array('b', [1]) * len(self.scores)
+        # Position of the best pull for each candidate, -1 for no match
+        self.best = array.array('l', [-1]) * len(candidates)
+        # (row, column) of every pair that has a score
+        self.scored = []
+
+    def set_row(self, row, name, scores):
+        self.names[row] = name
+        offset = row * self.shape[1]
+        for position in self.pulls.by_issue.get(name[1], ()):
+            self.mismatch[offset + position] = 0
+        best = None
+        for position, score in scores:
+            self.scores[offset + position] = score
+            self.scored.append((row, position))
+            key = (self.mismatch[offset + position], score, position)
+            if best is None or key < best:
+                best = key
+        if best:
+            self.best[row] = best[2]
+
+    def match(self, row, position):
+        # The (issue mismatch, distance, pull, candidate name, pull name)
+        # tuple yielded by compare_pull for this pair
+        offset = row * self.shape[1] + position
+        pull, pull_name = self.pulls.entries[position]
+        return (
+            bool(self.mismatch[offset]),
+            self.scores[offset],
+            pull,
+            self.names[row],
+            pull_name,
+        )
+
+    def best_match(self, row):
+        if self.best[row] >= 0:
+            return self.match(row, self.best[row])
+
+    def assign(self, threshold):
+        # Greedily pair candidates with pulls, best scores first, so each
+        # pull is claimed by at most one candidate.  Only pairs that would
+        # be good matches on their own are considered.
+        columns = self.shape[1]
+        good_pairs = []
+        for row, position in self.scored:
+            offset = row * columns + position
+            if not self.mismatch[offset] and self.scores[offset] < threshold:
+                good_pairs.append((self.scores[offset], row, position))
+        assigned = {}
+        claimed = set()
+        for score, row, position in sorted(good_pairs):
+            if row not in assigned and position not in claimed:
+                assigned[row] = position
+                claimed.add(position)
+        return assigned
+
 
 class MatchHandler(handler.CementBaseHandler):
     class Meta:
         label = 'matcher'
         interface = interfaces.MatchInterface
+        config_defaults = {
+            # JSON file containing a list of [pattern, replacement] pairs
+            # applied after the built in substitutions
+            'rules_file': '',
+        }
 
     def _setup(self, app):
         super(MatchHandler, self)._setup(app)
         self.app.extend('match', self)
+        rules = list(NORMALISE_RULES)
+        rules_file = self.app.config.get(
+            self._meta.config_section, 'rules_file')
+        if rules_file:
+            with open(os.path.expanduser(rules_file)) as extra_rules:
+                rules.append(
+                    [tuple(rule) for rule in json.load(extra_rules)])
+        self.normaliser = NameNormaliser(rules)
 
     def normalise_name(self, original_name):
-        # lowercase and change space characters
-        normal = original_name.lower()
-        normal = re.sub(r'[_+]', ' ', normal)
-        # Remove the file extension
-        normal = re.sub(r'.cb[rz]$', '', normal)
-        # tags in brackets can be stripped
-        normal = re.sub(r'\([^)]+\)', '', normal)
-        normal = re.sub(r'\[[^)]+\]', '', normal)
-        # Somtimes a random volume number slips in
-        normal = re.sub(r'\bv\d+\b', '', normal)
-        # strip release annotations
-        normal = re.sub(r'\bc2c\b', '', normal)
-        # Some substitutions for known bad nameing
-        normal = re.sub(r'the ', r' ', normal)
-        normal = re.sub(r'2000ad', '2000 ad', normal)
-        normal = re.sub(r'(abe sapien \d+) -.*', r'\g<1>', normal)
-        normal = re.sub(r'(b.p.r.d. hell on earth \d+) -.*', r'\g<1>', normal)
-        normal = re.sub(r'digital exclusives edition', '', normal)
-        normal = re.sub(r'garth ennis\'?', '', normal)
-        normal = re.sub(r'george romero\'?s', '', normal)
-        normal = re.sub(r'(outcast) by kirkman & azaceta', r'\g<1>', normal)
-        normal = re.sub(r'robin rises omega', r'robin rises', normal)
-        normal = re.sub(r'^trinity of sin - the phantom stranger',
-                        'the phantom stranger', normal)
-        normal = re.sub(r'by kirkman & azaceta', '', normal)
-        # Normalise spaces.
-        normal = re.sub(r'[_+]', ' ', normal)
-        normal = re.sub(r' +', ' ', normal)
-        normal = normal.strip()
-        # Fixup issue numbers
-        # Rewrite unicode half to 0.5
-        normal = re.sub(u'\xbd', r'0.5', normal)
-        # Remove random issue suffixes that Marvel seem to like
-        normal = re.sub(r'([.\d]+)(?:\.now)$', r'\g<1>', normal)
-        # Strip leading zeroes from issue number
-        normal = re.sub(r'\b0+([.\d]+)$', r'\g<1>', normal)
-        # Try to identify the issue number
-        issue_number = re.search(r'(\d+|)$', normal).group(1)
-        return normal, issue_number
+        return self.normaliser.normalise(original_name)
+
+    def normalise_many(self, names):
+        return self.normaliser.normalise_many(names)
 
-    def weighted_distance(self, pull_name, candidate_name):
+    def weighted_distance(self, pull_name, candidate_name, threshold=None):
         # The Levenshtein distance is the number of edits needed to
         # transform one string into another.  On a small string even
         # a small distance can indicate a large difference between
@@ -68,23 +289,86 @@ class MatchHandler(handler.CementBaseHandler):
         # try and counter this
         min_length = min([len(pull_name), len(candidate_name)])
         min_length = max([min_length, 1])
+        if threshold is None:
+            name_distance = distance(
+                unicode(candidate_name),
+                unicode(pull_name),
+            )
+            return float(name_distance)/min_length
+
+        # When only matches under the threshold are of interest anything
+        # that needs max_edits or more edits scores inf.  The difference in
+        # length is a lower bound on the distance, so those pairs are
+        # rejected without computing it.
+        max_edits = threshold * min_length
+        if abs(len(pull_name) - len(candidate_name)) >= max_edits:
+            return INFINITY
         name_distance = distance(
             unicode(candidate_name),
             unicode(pull_name),
         )
+        if name_distance >= max_edits:
+            return INFINITY
         return float(name_distance)/min_length
 
-    def compare_pull(self, candidate, pulls):
-        location, filename = candidate
-        candidate_name, candidate_issue = self.normalise_name(filename)
+    def _index_key(self, pull):
+        name = pull['name']
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return 'match:name:%s:%s:%s' % (
+            self.normaliser.fingerprint, pull['identifier'],
+            hashlib.sha1(name).hexdigest())
+
+    def index_pulls(self, pulls, cache=None):
+        named_pulls = []
         for pull in pulls:
-            try:
-                normalised, pull_issue = self.normalise_name(pull['name'])
-            except KeyError:
+            if 'name' not in pull:
                 self.app.log.error('Error: pull %r has no name.' % pull)
                 continue
-            weighted_distance = self.weighted_distance(normalised,
-                                                       candidate_name)
+            named_pulls.append(pull)
+        if not cache or not named_pulls:
+            return PullIndex(zip(named_pulls, self.normalise_many(
+                [pull['name'] for pull in named_pulls])))
+
+        # Normalised names are stored alongside the pull and expire with it
+        keys = [self._index_key(pull) for pull in named_pulls]
+        cached = [
+            tuple(json.loads(value)) if value else None
+            for value in cache.mget(keys)
+        ]
+        missing = [
+            index for index, value in enumerate(cached) if value is None]
+        self.app.log.debug('Normalised names cached for %d/%d pulls' % (
+            len(named_pulls) - len(missing), len(named_pulls)))
+        normalised = self.normalise_many(
+            [named_pulls[index]['name'] for index in missing])
+        with cache.pipeline() as pipe:
+            for index in missing:
+                pipe.ttl('pull:%s' % named_pulls[index]['identifier'])
+            ttls = pipe.execute()
+        with cache.pipeline() as pipe:
+            for index, ttl, names in zip(missing, ttls, normalised):
+                cached[index] = names
+                if ttl and ttl > 0:
+                    pipe.setex(keys[index], ttl, json.dumps(names))
+            pipe.execute()
+        return PullIndex(zip(named_pulls, cached))
+
+    def compare_pull(self, candidate, pulls, blocking=False, threshold=None):
+        location, filename = candidate
+        candidate_name, candidate_issue = self.normalise_name(filename)
+        if not isinstance(pulls, PullIndex):
+            pulls = self.index_pulls(pulls)
+        if blocking:
+            pulls = [
+                pulls.entries[position] for position in
+                pulls.plausible(candidate_name, candidate_issue)
+            ]
+        for pull, (normalised, pull_issue) in pulls:
+            weighted_distance = self.weighted_distance(
+                normalised, candidate_name, threshold=threshold)
+            if weighted_distance == INFINITY:
+                continue
             yield (
                 candidate_issue != pull_issue,
                 weighted_distance,
@@ -93,6 +377,63 @@ class MatchHandler(handler.CementBaseHandler):
                 (normalised, pull_issue),
             )
 
+    def score_candidate(self, candidate, pulls, threshold=None,
+                        blocking=True):
+        location, filename = candidate
+        candidate_name, candidate_issue = self.normalise_name(filename)
+        positions = range(len(pulls))
+        if blocking:
+            positions = pulls.plausible(candidate_name, candidate_issue)
+        scores = []
+        for position in positions:
+            pull, (normalised, pull_issue) = pulls.entries[position]
+            weighted_distance = self.weighted_distance(
+                normalised, candidate_name, threshold=threshold)
+            if weighted_distance != INFINITY:
+                scores.append((position, weighted_distance))
+        return (candidate_name, candidate_issue), scores
+
+    def score_matrix(self, candidates, pulls, threshold=None, jobs=1,
+                     blocking=True):
+        if not isinstance(pulls, PullIndex):
+            pulls = self.index_pulls(pulls)
+        matrix = ScoreMatrix(candidates, pulls)
+        if jobs <= 1 or len(candidates) < 2:
+            for row, candidate in enumerate(candidates):
+                matrix.set_row(row, *self.score_candidate(
+                    candidate, pulls, threshold, blocking=blocking))
+            return matrix
+        pool = multiprocessing.Pool(
+            jobs, _init_worker, (self, pulls, threshold, blocking))
+        try:
+            chunksize = max(1, len(candidates) // (jobs * 4))
+            rows = pool.imap(_score_candidate, candidates, chunksize)
+            for row, (name, scores) in enumerate(rows):
+                matrix.set_row(row, name, scores)
+        finally:
+            pool.terminate()
+        return matrix
+
+    def best_matches(self, candidates, pulls, threshold, jobs=1,
+                     assign=False):
+        matrix = self.score_matrix(candidates, pulls, threshold, jobs=jobs)
+        assigned = {}
+        if assign:
+            assigned = matrix.assign(threshold)
+        for row, candidate in enumerate(candidates):
+            if row in assigned:
+                yield candidate, matrix.match(row, assigned[row]), True
+                continue
+            best_match = matrix.best_match(row)
+            if not best_match:
+                continue
+            # When assigning, a good match that was not assigned has lost
+            # its pull to a better candidate
+            good_match = bool(
+                not assign and best_match[1] < threshold and not best_match[0]
+            )
+            yield candidate, best_match, good_match
+
 
 def load(app=None):
     handler.register(MatchHandler)
@@ -1,6 +1,13 @@
 from datetime import timedelta
+import itertools
 import json
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
+import sys
+import tempfile
+import threading
+import time
 
 from cement.core import controller, handler, hook
 from dateutil.parser import parse as parse_date
@@ -9,6 +16,104 @@ import xdg.BaseDirectory
 from pullsync.ext import interfaces
 
 
+def pull_weight(pull):
+    # Pulls without a stream sort after everything else and a pull without
+    # a usable weight is treated as 1.0
+    if not pull.get('stream_id'):
+        return 2.0
+    try:
+        return float(pull['weight'])
+    except (KeyError, TypeError, ValueError):
+        return 1.0
+
+
+UNREAD_TTL = timedelta(1)
+
+
+class PullJournal(object):
+    # Append-only record of the raw pulls fetched in one refresh.  Each run
+    # writes a new journal and the index naming it is only swapped in once
+    # every page has been written, so a failed refresh leaves the previous
+    # snapshot in place.
+    index_name = 'pulls.idx.json'
+
+    def __init__(self, directory, ttl=UNREAD_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.index_path = os.path.join(directory, self.index_name)
+        self.journal = None
+        self.offsets = {}
+
+    def start(self):
+        self.created = time.time()
+        self.offsets = {}
+        descriptor, path = tempfile.mkstemp(
+            prefix='pulls-', suffix='.jsonl', dir=self.directory)
+        self.name = os.path.basename(path)
+        self.journal = os.fdopen(descriptor, 'wb')
+
+    def append(self, pulls):
+        for pull, raw in pulls:
+            self.offsets[pull['id']] = self.journal.tell()
+            self.journal.write(raw + '\n')
+
+    def commit(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal.close()
+        previous = self.load()
+        index_tmp = self.index_path + '.tmp'
+        with open(index_tmp, 'w') as index_file:
+            json.dump({
+                'journal': self.name,
+                'created': self.created,
+                'ttl': self.ttl.total_seconds(),
+                'pulls': self.offsets,
+            }, index_file)
+        os.rename(index_tmp, self.index_path)
+        self.journal = None
+        if previous and previous['journal'] != self.name:
+            self._remove(previous['journal'])
+
+    def abort(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+            self._remove(self.name)
+
+    def _remove(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def load(self):
+        # Index of the last complete journal, or None if there isn't one
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return None
+
+    def read(self, index=None):
+        index = index or self.load()
+        if not index:
+            return
+        with open(os.path.join(self.directory, index['journal']),
+                  'rb') as journal:
+            for line in journal:
+                yield line.rstrip('\n')
+
+    def get(self, pull_id, index=None):
+        index = index or self.load()
+        if not index or unicode(pull_id) not in index['pulls']:
+            return None
+        with open(os.path.join(self.directory, index['journal']),
+                  'rb') as journal:
+            journal.seek(index['pulls'][unicode(pull_id)])
+            return journal.readline().rstrip('\n')
+
+
 class FetchError(Exception):
     pass
 
@@ -21,40 +126,127 @@ class PullDB(handler.CementBaseHandler):
     class Meta:
         interface = interfaces.DataInterface
         label = 'pulldb'
+        config_section = 'pulldb'
+        config_defaults = {
+            # Number of keys fetched from redis per round trip
+            'batch_size': 100,
+            # Number of result pages fetched ahead of the page being read
+            'prefetch_pages': 2,
+            # Number of pulls refreshed concurrently by refresh_pulls
+            'refresh_threads': 4,
+        }
 
     def _setup(self, app):
         super(PullDB, self)._setup(app)
         self.app.extend('pulldb', self)
-        self.base_url = self.app.config.get('pulldb', 'base_url')
+        self.base_url = self.app.config.get(
+            self._meta.config_section, 'base_url')
         self.data_dir = xdg.BaseDirectory.save_data_path(
             self.app._meta.label)
-        self.new_file = os.path.join(self.data_dir, 'new_pulls.json')
-        self.unread_file = os.path.join(self.data_dir, 'unread_pulls.json')
+        self._pool = None
+        self._local = threading.local()
 
-    def extract_pulls(self, result, prefix='pull'):
-        pulls = []
-        for pull in result['results']:
-            key = '%s:%s' % (prefix, pull['pull']['id'])
-            pulls.append((key, json.dumps(pull['pull'])))
-        return pulls
+    @property
+    def batch_size(self):
+        return int(self.app.config.get(
+            self._meta.config_section, 'batch_size'))
+
+    @property
+    def prefetch_pages(self):
+        return max(1, int(self.app.config.get(
+            self._meta.config_section, 'prefetch_pages')))
+
+    @property
+    def refresh_threads(self):
+        return max(1, int(self.app.config.get(
+            self._meta.config_section, 'refresh_threads')))
+
+    def _index_pull(self, pipe, pull):
+        pipe.sadd('pulls:unread', pull['id'])
+        pipe.zadd('pulls:weight', pull_weight(pull), pull['id'])
+
+    def cache_pulls(self, pulls, ttl=UNREAD_TTL, size=50, overwrite=True):
+        # Pulls are added to the pulls:unread and pulls:weight indexes in
+        # the same pipeline so they can be listed without scanning the
+        # keyspace.  Without overwrite pulls already cached are kept.
+        pulls = iter(pulls)
+        count = 0
+        while True:
+            batch = list(itertools.islice(pulls, size))
+            if not batch:
+                break
+            with self.app.redis.pipeline() as pipe:
+                for pull, value in batch:
+                    key = 'pull:%s' % pull['id']
+                    if overwrite:
+                        pipe.setex(key, ttl, value)
+                    else:
+                        pipe.set(key, value, ex=ttl, nx=True)
+                    self._index_pull(pipe, pull)
+                pipe.execute()
+            count += len(batch)
+        return count
+
+    def restore_snapshot(self):
+        # Loads the pulls from the last complete journal with whatever is
+        # left of their ttl
+        journal = PullJournal(self.data_dir)
+        index = journal.load()
+        if not index:
+            self.app.log.warn('No snapshot of unread pulls to restore')
+            return 0
+        ttl = int(index['created'] + index['ttl'] - time.time())
+        if ttl <= 0:
+            self.app.log.warn('Snapshot of unread pulls has expired')
+            return 0
+        pulls = ((json.loads(raw), raw) for raw in journal.read(index))
+        count = self.cache_pulls(
+            pulls, ttl=ttl, size=self.batch_size, overwrite=False)
+        self.app.log.info('Restored %d pulls expiring in %ds' % (count, ttl))
+        return count
+
+    def rebuild_index(self):
+        self.app.log.info('Rebuilding index of cached pulls')
+        keys = self.app.redis.client.scan_iter(
+            'pull:*', count=self.batch_size)
+        with self.app.redis.pipeline() as pipe:
+            for key, value in self.app.redis.multi_get(
+                    keys, size=self.batch_size):
+                if value:
+                    self._index_pull(pipe, json.loads(value))
+            pipe.set('pulls:indexed', 1)
+            pipe.execute()
+
+    def _ensure_index(self):
+        # The indexes can't be trusted just because they exist, a pull
+        # cached before the first rebuild would create them with only that
+        # pull in them
+        if not self.app.redis.client.exists('pulls:indexed'):
+            self.rebuild_index()
+
+    def _remove_expired(self, pull_ids):
+        # Expired pulls are only removed from the indexes when next listed
+        self.app.log.debug('Removing %d expired pulls from index' % (
+            len(pull_ids),))
+        with self.app.redis.pipeline() as pipe:
+            pipe.srem('pulls:unread', *pull_ids)
+            pipe.zrem('pulls:weight', *pull_ids)
+            pipe.execute()
 
     def refresh_unread(self):
         path = '/api/pulls/list/unread'
-        # Set all existing keys to expire in 5 seconds
+        # Set all existing keys to expire in 5 seconds.  Pulls cached
+        # before the index was built are only found once it is.
+        self._ensure_index()
         pipe = self.app.redis.pipeline()
-        for key in self.app.redis.keys('pull:*'):
-            pipe.expire(key, 5)
+        for pull_id in self.app.redis.client.sscan_iter('pulls:unread'):
+            pipe.expire('pull:%s' % pull_id, 5)
         pipe.execute()
 
-        position = None
-        while True:
-            self.app.log.debug('fetching %s %r' % (path, position))
-            result = self.fetch_page(path, cursor=position)
-            if not result['more_results']:
-                break
-            position = result.get('next_page')
+        for result in self.iter_pages(path):
+            pass
 
-    def fetch_page(self, path, cursor=None, cache=True):
+    def _request_page(self, path, cursor=None):
         if cursor:
             path = path + '?position=%s' % cursor
         self.app.log.info('Sending request for %r' % (path,))
@@ -62,54 +254,139 @@ class PullDB(handler.CementBaseHandler):
         if resp.status != 200:
             self.app.log.error(resp, content)
             raise FetchError('Unable to fetch unread pulls')
-        else:
-            with open(self.unread_file, 'w') as unread_pulls:
-                unread_pulls.write(content)
-            result = json.loads(content)
-            if cache:
-                self.app.redis.multi_set(
-                    self.extract_pulls(result),
-                    ttl=timedelta(1),
-                )
-        return result
+        return content
+
+    def extract_pulls(self, result):
+        pulls = []
+        for pull in result['results']:
+            pulls.append((pull['pull'], json.dumps(pull['pull'])))
+        return pulls
+
+    def iter_pages(self, path, cache=True):
+        # The next page is requested in a background thread while the
+        # current one is cached and handed to the caller.  Only the fetcher
+        # thread uses the http client, so callers must not send their own
+        # requests until the pages have been consumed.  Cached pages are
+        # also written to a journal which replaces the previous snapshot
+        # once the last page has been read.
+        pages = Queue.Queue(maxsize=self.prefetch_pages)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                except Queue.Full:
+                    continue
+                return True
+            return False
+
+        def fetch_pages():
+            position = None
+            try:
+                while True:
+                    self.app.log.debug('fetching %s %r' % (path, position))
+                    result = json.loads(
+                        self._request_page(path, cursor=position))
+                    if not put((None, (result, self.extract_pulls(result)))):
+                        return
+                    if not result['more_results']:
+                        break
+                    position = result.get('next_page')
+            except Exception:
+                put((sys.exc_info(), None))
+            else:
+                put((None, None))
+
+        fetcher = threading.Thread(target=fetch_pages, name='pulldb-fetch')
+        fetcher.daemon = True
+        fetcher.start()
+        journal = None
+        if cache:
+            journal = PullJournal(self.data_dir)
+            journal.start()
+        try:
+            while True:
+                error, page = pages.get()
+                if error:
+                    # Re-raise errors from the fetcher with their traceback
+                    raise error[0], error[1], error[2]
+                if page is None:
+                    break
+                result, pulls = page
+                if cache:
+                    self.cache_pulls(pulls)
+                    journal.append(pulls)
+                yield result
+            if journal:
+                journal.commit()
+        finally:
+            stop.set()
+            if journal:
+                journal.abort()
 
     def fetch_new(self):
-        path = '/api/pulls/list/new'
-        position = None
-        results = []
-        while True:
-            self.app.log.debug('fetching %s %r' % (path, position))
-            results_page = self.fetch_page(path, cursor=position, cache=False)
-            results.extend(
-                [result['pull'] for result in results_page['results']])
-            if not results_page['more_results']:
-                break
-            position = results_page.get('next_page')
-        return results
+        for results_page in self.iter_pages(
+                '/api/pulls/list/new', cache=False):
+            for result in results_page['results']:
+                yield result['pull']
 
     def fetch_unread(self):
-        path = '/api/pulls/list/unread'
-        position = None
-        results = []
-        while True:
-            self.app.log.debug('fetching %s %r' % (path, position))
-            results_page = self.fetch_page(path, cursor=position)
-            results.extend(
-                [result['pull'] for result in results_page['results']])
-            if not results_page['more_results']:
-                break
-            position = results_page.get('next_page')
-        return results
+        for results_page in self.iter_pages('/api/pulls/list/unread'):
+            for result in results_page['results']:
+                yield result['pull']
+
+    def _load_pulls(self, pull_ids):
+        keys = ('pull:%s' % pull_id for pull_id in pull_ids)
+        expired = []
+        for key, value in self.app.redis.multi_get(
+                keys, size=self.batch_size):
+            if value:
+                yield json.loads(value)
+            else:
+                expired.append(key.split(':', 1)[1])
+        if expired:
+            self._remove_expired(expired)
 
     def list_unread(self):
-        for key in self.app.redis.client.keys('pull:*'):
-            yield json.loads(self.app.redis.get(key))
+        self._ensure_index()
+        return self._load_pulls(self.app.redis.client.sscan_iter(
+            'pulls:unread', count=self.batch_size))
+
+    def iter_by_weight(self, limit=None):
+        self._ensure_index()
+        start = 0
+        count = 0
+        while limit is None or count < limit:
+            members = self.app.redis.client.zrange(
+                'pulls:weight', start, start + self.batch_size - 1,
+                withscores=True)
+            if not members:
+                break
+            values = self.app.redis.client.mget(
+                ['pull:%s' % pull_id for pull_id, weight in members])
+            expired = []
+            for (pull_id, weight), value in zip(members, values):
+                if not value:
+                    expired.append(pull_id)
+                elif limit is None or count < limit:
+                    count += 1
+                    yield weight, pull_id, json.loads(value)
+            if expired:
+                self._remove_expired(expired)
+            start += len(members) - len(expired)
 
     def list_unseen(self):
-        for pull in self.list_unread():
-            if not self.app.redis.client.sismember(
-                    'gs:seen', int(pull['id'])):
-                yield pull
+        self._ensure_index()
+        # Let redis work out which pulls are not in the longbox
+        return self._load_pulls(
+            self.app.redis.client.sdiff('pulls:unread', 'gs:seen'))
+
+    def seen_status(self, pull_ids):
+        with self.app.redis.pipeline() as pipe:
+            for pull_id in pull_ids:
+                pipe.sismember('gs:seen', pull_id)
+            return [bool(seen) for seen in pipe.execute()]
 
     def pull_new(self, pull_id):
         pull_identifier = str(pull_id)
@@ -161,28 +438,61 @@ class PullDB(handler.CementBaseHandler):
                 self.app.log.warn('Unable to mark pull read pull %s: %r' % (
                     pull, result))
 
-    def refresh_pull(self, pull_id, prefix='pull'):
+    def _fetch_pull(self, pull_id, http=None):
         path = '/api/pulls/%d/get' % (int(pull_id),)
         self.app.log.info('Sending request for: %r' % path)
-        resp, content = self.app.google.client.request(self.base_url + path)
+        resp, content = (http or self.app.google.client).request(
+            self.base_url + path)
         if resp.status != 200:
             self.app.log.error(resp, content)
-            raise FetchError('Unable to fetch pull %d' % pull_id)
+            raise FetchError('Unable to fetch pull %d' % int(pull_id))
+        response = json.loads(content)
+        if len(response['results']) > 1:
+            self.app.log.warn(
+                'Multiple results in data store for pull id %d' % (
+                    int(pull_id),))
+        for pull in response['results']:
+            return pull['pull']
+
+    def _cache_pull(self, pipe, pull, prefix='pull'):
+        key = '%s:%s' % (prefix, pull['id'])
+        if pull['read'] == 'True':
+            # Only cache read pulls for 30s
+            ttl = 30
         else:
-            response = json.loads(content)
-            if len(response['results']) > 1:
-                self.app.log.warn(
-                    'Multiple results in data store for pull id %d' % pull_id)
-            for pull in response['results']:
-                key = '%s:%s' % (prefix, pull['pull']['id'])
-                if pull['pull']['read'] == 'True':
-                    # Only cache read pulls for 30s
-                    ttl = 30
-                else:
-                    ttl = timedelta(1)
-                self.app.redis.setex(
-                    key, ttl, json.dumps(pull['pull']))
-                return pull['pull']
+            ttl = UNREAD_TTL
+        pipe.setex(key, ttl, json.dumps(pull))
+        self._index_pull(pipe, pull)
+
+    def refresh_pull(self, pull_id, prefix='pull'):
+        pull = self._fetch_pull(pull_id)
+        if pull:
+            with self.app.redis.pipeline() as pipe:
+                self._cache_pull(pipe, pull, prefix=prefix)
+                pipe.execute()
+        return pull
+
+    def _fetch_pull_threaded(self, pull_id):
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.app.google.new_client()
+        return self._fetch_pull(pull_id, http=self._local.http)
+
+    def refresh_pulls(self, pull_ids, prefix='pull'):
+        # Pulls are fetched concurrently, each worker thread keeping its
+        # own client, and cached in a single pipeline.  Returns the pulls
+        # in the same order as pull_ids, None for any not found.
+        pull_ids = list(pull_ids)
+        if not pull_ids:
+            return []
+        if not self._pool:
+            self._pool = ThreadPool(self.refresh_threads)
+        pulls = self._pool.map(self._fetch_pull_threaded, pull_ids)
+        with self.app.redis.pipeline() as pipe:
+            for pull in pulls:
+                if pull:
+                    self._cache_pull(pipe, pull, prefix=prefix)
+            pipe.execute()
+        return pulls
 
 
 class FetchPulls(controller.CementBaseController):
@@ -196,7 +506,24 @@ class FetchPulls(controller.CementBaseController):
         self.app.pulldb.refresh_unread()
 
 
+class CacheController(controller.CementBaseController):
+    class Meta:
+        label = 'cache'
+        stacked_on = 'base'
+        stacked_type = 'nested'
+        description = 'Manage the redis cache of pulls'
+
+    @controller.expose(hide=True)
+    def default(self):
+        self.app.args.print_help()
+
+    @controller.expose(help='Load the last fetched pulls into redis')
+    def restore(self):
+        self.app.pulldb.restore_snapshot()
+
+
 def load(app=None):
     handler.register(FetchPulls)
+    handler.register(CacheController)
     pulldb = PullDB()
     hook.register('post_setup', pulldb._setup)
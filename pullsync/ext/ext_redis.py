@@ -1,3 +1,5 @@
+import itertools
+
 from cement.core import cache, handler, hook
 import redis
 
@@ -39,6 +41,15 @@ class RedisCache(handler.CementBaseHandler):
                         pipe.set(key, value)
                 pipe.execute()
 
+    def multi_get(self, keys, size=50):
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, size))
+            if not batch:
+                break
+            for key, value in zip(batch, self.client.mget(batch)):
+                yield key, value
+
 
 def load(app=None):
     redis_handler = RedisCache()
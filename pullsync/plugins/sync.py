@@ -1,12 +1,40 @@
+import httplib
+import itertools
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import socket
+import threading
 import time
 
 from cement.core import controller, handler
 from dateutil.parser import parse as parse_date
 
 
+class DownloadProgress(object):
+    # Shared by the download workers to report how many files are done
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+        self.total = 0
+        self.finished = 0
+        self.failed = 0
+
+    def add(self):
+        with self.lock:
+            self.total += 1
+
+    def done(self, name, success=True):
+        with self.lock:
+            self.finished += 1
+            if not success:
+                self.failed += 1
+            self.log.info('%s %r [%d/%d]' % (
+                'Fetched' if success else 'Failed to fetch',
+                name, self.finished, self.total))
+
+
 class SyncController(controller.CementBaseController):
     class Meta:
         label = 'sync'
@@ -32,22 +60,58 @@ class SyncController(controller.CementBaseController):
                 ),
                 'action': 'store_true',
             }),
+            (['--parallel'], {
+                'help': 'Number of files to download at once',
+                'type': int,
+                'default': 1,
+            }),
+            (['--retries'], {
+                'help': 'Number of times to retry a failed download',
+                'type': int,
+                'default': 2,
+            }),
         ]
 
     def weighted_pulls(self):
-        new_items = self.app.pulldb.list_unread()
-        for pull in new_items:
-            yield float(pull['weight']), pull['id'], pull
+        return self.app.pulldb.iter_by_weight()
+
+    def refreshed_pulls(self, size):
+        # Pulls are refreshed a window at a time with the next window
+        # requested in the background while the current one is checked
+        pulls = (pull_detail for weight, pull, pull_detail
+                 in self.weighted_pulls())
+        prefetch = ThreadPool(1)
+
+        def request_window():
+            pull_ids = [int(pull_detail['identifier'])
+                        for pull_detail in itertools.islice(pulls, size)]
+            if pull_ids:
+                return pull_ids, prefetch.apply_async(
+                    self.app.pulldb.refresh_pulls, (pull_ids,))
+            return [], None
+
+        try:
+            pull_ids, pending = request_window()
+            while pending:
+                next_ids, next_pending = request_window()
+                files = self.app.longbox.file_details(pull_ids)
+                for pull_id, pull_detail in zip(pull_ids, pending.get()):
+                    yield pull_id, pull_detail, files.get(pull_id)
+                pull_ids, pending = next_ids, next_pending
+        finally:
+            prefetch.close()
 
     def exportable_items(self):
         count = 0
         stalled_streams = set()
-        for weight, pull, pull_detail in sorted(self.weighted_pulls()):
+        for pull_id, pull_detail, items in self.refreshed_pulls(
+                self.app.pargs.count):
             if count >= self.app.pargs.count:
                 break
-            pull_id = int(pull_detail['identifier'])
-            pull_detail = self.app.pulldb.refresh_pull(pull_id)
             self.app.log.debug('Checking pull %d' % pull_id)
+            if not pull_detail:
+                self.app.log.warn('Pull %d not found, skipping' % pull_id)
+                continue
             if pull_detail['read'] == 'True':
                 self.app.log.debug(
                     'Issue %d is no longer unread, skipping' % pull_id
@@ -66,7 +130,9 @@ class SyncController(controller.CementBaseController):
                         pull_detail['identifier'],
                         pull_detail['stream_id']))
                 continue
-            if not self.app.longbox.check_prefix(pull_id):
+            if not items:
+                items = self.app.longbox.list_prefix(pull_id)
+            if not items:
                 self.app.log.warn(
                     'Issue %s(%s) not in longbox.  Stalling stream %s.' % (
                         pull_detail['name'],
@@ -74,12 +140,12 @@ class SyncController(controller.CementBaseController):
                         pull_detail['stream_id']))
                 stalled_streams.add(pull_detail['stream_id'])
                 continue
-            yield pull_detail
+            yield pull_detail, items
             count = count + 1
 
     def expire_pulls(self, directory, expired_pulls):
         for filename in os.listdir(self.app.pargs.destination):
-            if filename.endswith(('.cbr', '.cbz')):
+            if filename.endswith(('.cbr', '.cbz', '.part')):
                 for expired_id in expired_pulls:
                     if expired_id in filename:
                         self.app.log.debug('Removing old pull %r' % filename)
@@ -88,6 +154,9 @@ class SyncController(controller.CementBaseController):
 
     def identify_pulls(self, directory):
         for path in os.listdir(directory):
+            if path.endswith('.part'):
+                # Incomplete downloads
+                continue
             match = re.search(r'\b([a-z0-9]{6})\b', path)
             if match:
                 file_id = match.group(1)
@@ -97,6 +166,28 @@ class SyncController(controller.CementBaseController):
                 except ValueError:
                     pass
 
+    def fetch_file(self, pull_id, source, destination, progress):
+        for attempt in range(self.app.pargs.retries + 1):
+            if attempt:
+                self.app.log.warn('Retrying %r [%d/%d]' % (
+                    source['name'], attempt, self.app.pargs.retries))
+            self.app.log.info('Fetching %r -> %r' % (
+                source['name'], destination))
+            try:
+                fetched = self.app.longbox.fetch_file(
+                    source, destination, pull_id=pull_id)
+            except (socket.error, IOError, httplib.HTTPException) as error:
+                # Dropped connections are retried, resuming from the
+                # partial download
+                self.app.log.warn('Error fetching %r: %r' % (
+                    source['name'], error))
+                continue
+            if fetched:
+                progress.done(source['name'])
+                return True
+        progress.done(source['name'], success=False)
+        return False
+
     def safe_name(self, name):
         name = re.sub(r'[/:]', '-', name)
         return name
@@ -108,17 +199,17 @@ class SyncController(controller.CementBaseController):
         )
         self.app.log.debug('existing issues: %r' % existing_pulls)
         sync_pulls = set()
-        for pull in self.exportable_items():
+        progress = DownloadProgress(self.app.log)
+        pool = None
+        if self.app.pargs.parallel > 1:
+            pool = ThreadPool(self.app.pargs.parallel)
+        fetches = []
+        for pull, items in self.exportable_items():
             pull_id = int(pull['identifier'])
             print '%06d %s' % (
                 int(float(pull['weight'])*1e6),
                 pull['name'],
             )
-            items = self.app.longbox.check_prefix(pull_id)
-            if not items:
-                self.app.log.warn(
-                    'Could not find file details for %d, skipping' % pull_id)
-                continue
             source = None
             for item in items:
                 if item['contentType'] == 'application/x-cbr':
@@ -142,9 +233,30 @@ class SyncController(controller.CementBaseController):
                     'Skipping file %r.  Already present in destination.' % (
                         source['name']))
                 continue
-            self.app.log.info('Fetching %r -> %r' % (
-                source['name'], destination))
-            self.app.longbox.fetch_file(source, destination)
+            progress.add()
+            if pool:
+                fetches.append((source, pool.apply_async(
+                    self.fetch_file,
+                    (pull_id, source, destination, progress))))
+            else:
+                self.fetch_file(pull_id, source, destination, progress)
+
+        if pool:
+            pool.close()
+            try:
+                # Failures are reported in sync order once all fetches
+                # finish
+                for source, fetch in fetches:
+                    if not fetch.get():
+                        self.app.log.error(
+                            'Unable to fetch %r' % source['name'])
+            finally:
+                # Other fetches still finish so they don't leave partial
+                # files behind
+                pool.join()
+        if progress.total:
+            self.app.log.info('Fetched %d of %d files' % (
+                progress.finished - progress.failed, progress.total))
 
         if self.app.pargs.strict:
             expired_pulls = existing_pulls - sync_pulls
@@ -52,13 +52,7 @@ class TodoSync(controller.CementBaseController):
         return seen, entry, extra
 
     def weighted_pulls(self):
-        new_items = self.app.pulldb.list_unread()
-        for pull_detail in new_items:
-            if not pull_detail.get('stream_id'):
-                weight = 2.0
-            else:
-                weight = float(pull_detail['weight'])
-            yield weight, pull_detail['id'], pull_detail
+        return self.app.pulldb.iter_by_weight()
 
     def write_todo_file(self, entries):
         backup_name = '%s.%s' % (
@@ -75,7 +69,7 @@ class TodoSync(controller.CementBaseController):
             seen, entry, extra  = self.fetch_todo_entries()
             handled = set()
             new_entries = []
-            pulls = sorted(list(self.weighted_pulls()))
+            pulls = self.weighted_pulls()
             for weight, pull, pull_detail in pulls:
                 pull_id = int(pull_detail['identifier'])
                 if pull_id in handled:
@@ -6,6 +6,8 @@ import time
 from cement.core import controller, handler
 from dateutil.parser import parse as parse_date
 
+from pullsync.ext.ext_pulldb import pull_weight
+
 
 class ToRead(controller.CementBaseController):
     class Meta:
@@ -20,26 +22,22 @@ class ToRead(controller.CementBaseController):
         ]
 
     def weighted_pulls(self, new=False):
-        if new:
-            new_items = self.app.pulldb.fetch_new()
-        else:
-            new_items = self.app.pulldb.list_unread()
-        for pull_detail in new_items:
-            pull = 'pull:%s' % pull_detail['identifier']
-            try:
-                weight = float(pull_detail['weight'])
-            except ValueError:
-                # if weight is not defined, treat as 1.0
-                weight = 1.0
-            yield weight, pull, pull_detail
+        if not new:
+            return self.app.pulldb.iter_by_weight()
+        return sorted(
+            (pull_weight(pull_detail), pull_detail['id'], pull_detail)
+            for pull_detail in self.app.pulldb.fetch_new()
+        )
 
     @controller.expose(hide=True)
     def default(self):
-        new_items = sorted(self.weighted_pulls(new=self.app.pargs.new))
+        new_items = list(self.weighted_pulls(new=self.app.pargs.new))
+        seen_pulls = self.app.pulldb.seen_status(
+            [int(pull['identifier']) for weight, key, pull in new_items])
         try:
-            for weight, pull_key, pull in new_items:
+            for (weight, pull_key, pull), seen in zip(new_items, seen_pulls):
                 pull_id = int(pull['identifier'])
-                if not self.app.redis.sismember('gs:seen', pull_id):
+                if not seen:
                     note = '*'
                 else:
                     note = ' '
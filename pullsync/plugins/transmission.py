@@ -37,6 +37,20 @@ class TransmissionController(controller.CementBaseController):
                 'choices': ['new', 'unseen'],
                 'default': 'unseen'
             }),
+            (['--cache-names'], {
+                'help': 'Cache normalised pull names in redis',
+                'action': 'store_true',
+            }),
+            (['--jobs', '-j'], {
+                'help': 'Number of processes to use for matching',
+                'action': 'store',
+                'type': int,
+                'default': 1,
+            }),
+            (['--assign'], {
+                'help': 'Match each pull to at most one file',
+                'action': 'store_true',
+            }),
         ]
 
     def _pull_if_new(self, best_match):
@@ -68,19 +82,11 @@ class TransmissionController(controller.CementBaseController):
         for pull in pulls:
             yield pull
 
-    def find_matches(self, candidates, pulls, threshold):
-        for candidate in candidates:
-            matches = [
-                match for match in self.app.match.compare_pull(
-                    candidate, pulls)
-            ]
-            if matches:
-                best_match = min(matches)
-            else:
-                continue
-            good_match = bool(
-                best_match[1] < threshold and not best_match[0]
-            )
+    def find_matches(self, candidates, pulls, threshold, cache=None,
+                     jobs=1, assign=False):
+        pulls = self.app.match.index_pulls(pulls, cache=cache)
+        for candidate, best_match, good_match in self.app.match.best_matches(
+                candidates, pulls, threshold, jobs=jobs, assign=assign):
             logger = self.app.log.debug
             if good_match:
                 logger = self.app.log.info
@@ -103,8 +109,12 @@ class TransmissionController(controller.CementBaseController):
         pulls = list(self.identify_unseen(
             check_type=self.app.pargs.check_type))
         self.app.log.debug('Unseen pulls: %r' % pulls)
+        cache = None
+        if self.app.pargs.cache_names:
+            cache = self.app.redis
         for good_match, best_match, candidate in self.find_matches(
-                candidates, pulls, self.app.pargs.threshold):
+                candidates, pulls, self.app.pargs.threshold, cache=cache,
+                jobs=self.app.pargs.jobs, assign=self.app.pargs.assign):
             if good_match:
                 print('Found match: [%s -> %s] <%0.4f>' % (
                     best_match[3][0], best_match[4][0], best_match[1]))
@@ -36,6 +36,20 @@ class UploadController(controller.CementBaseController):
                 'choices': ['new', 'unseen'],
                 'default': 'unseen'
             }),
+            (['--cache-names'], {
+                'help': 'Cache normalised pull names in redis',
+                'action': 'store_true',
+            }),
+            (['--jobs', '-j'], {
+                'help': 'Number of processes to use for matching',
+                'action': 'store',
+                'type': int,
+                'default': 1,
+            }),
+            (['--assign'], {
+                'help': 'Match each pull to at most one file',
+                'action': 'store_true',
+            }),
         ]
 
     def _pull_if_new(self, best_match):
@@ -43,9 +57,14 @@ class UploadController(controller.CementBaseController):
         if best_match['pulled'] == 'False':
             self.app.pulldb.pull_new(pull_id)
 
-    def commit_file(self, best_match, candidate):
+    def commit_file(self, best_match, candidate, uploaded=None):
         pull_id = int(best_match['identifier'])
-        detail = self.app.longbox.check_prefix(pull_id)
+        if uploaded is None:
+            detail = self.app.longbox.check_prefix(pull_id)
+        else:
+            # Cached files were looked up up front for every pull
+            detail = uploaded.get(pull_id) or self.app.longbox.list_prefix(
+                pull_id)
         if detail:
             self._pull_if_new(best_match)
             self.app.log.info('Pull %d has already been uploaded, skipping' % (
@@ -56,7 +75,9 @@ class UploadController(controller.CementBaseController):
             except subprocess.CalledProcessError as error:
                 self.app.log.error('Error copying file: %r' % error)
             else:
-                self.app.longbox.check_prefix(pull_id)
+                self.app.longbox.record_upload(pull_id)
+                self.app.longbox.forget_miss(pull_id)
+                self.app.longbox.list_prefix(pull_id)
                 self._pull_if_new(best_match)
 
     def scan_dir(self, directory):
@@ -92,17 +113,11 @@ class UploadController(controller.CementBaseController):
             'gsutil', 'cp', filename, destination,
         ])
 
-    def find_matches(self, candidates, pulls, threshold):
-        for candidate in candidates:
-            matches = [match for match in self.app.match.compare_pull(
-                candidate, pulls)]
-            if matches:
-                best_match = min(matches)
-            else:
-                continue
-            good_match = bool(
-                best_match[1] < threshold and not best_match[0]
-            )
+    def find_matches(self, candidates, pulls, threshold, cache=None,
+                     jobs=1, assign=False):
+        pulls = self.app.match.index_pulls(pulls, cache=cache)
+        for candidate, best_match, good_match in self.app.match.best_matches(
+                candidates, pulls, threshold, jobs=jobs, assign=assign):
             logger = self.app.log.debug
             if good_match:
                 logger = self.app.log.info
@@ -120,13 +135,21 @@ class UploadController(controller.CementBaseController):
         pulls = list(self.identify_unseen(
             check_type=self.app.pargs.check_type))
         self.app.log.debug('Unseen pulls: %r' % pulls)
+        cache = None
+        if self.app.pargs.cache_names:
+            cache = self.app.redis
+        uploaded = None
+        if self.app.pargs.commit:
+            uploaded = self.app.longbox.file_details(
+                pull['identifier'] for pull in pulls)
         for good_match, best_match, candidate in self.find_matches(
-                candidates, pulls, self.app.pargs.threshold):
+                candidates, pulls, self.app.pargs.threshold, cache=cache,
+                jobs=self.app.pargs.jobs, assign=self.app.pargs.assign):
             if good_match:
                 print('Found match: [%s -> %s] <%0.4f>' % (
                     best_match[3][0], best_match[4][0], best_match[1]))
                 if self.app.pargs.commit:
-                    self.commit_file(best_match[2], candidate)
+                    self.commit_file(best_match[2], candidate, uploaded)
 
 
 def load(app=None):
@@ -3,6 +3,9 @@ setup(
     name = "pullsync",
     version = "0.0.3_pre3",
     packages = find_packages(),
+    package_data = {
+        'pullsync.ext': ['data/*.json'],
+    },
     install_requires=[
         'cement',
         'httplib2>=0.9.1',
@@ -12,7 +15,7 @@ setup(
         'python-dateutil',
         'python-Levenshtein',
         'pyxdg',
-        'redis',
+        'redis<3',
         'transmissionrpc',
     ],
     entry_points={
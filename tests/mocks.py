@@ -1,9 +1,40 @@
+from __future__ import absolute_import
+
 import json
 import mock
 
+from pullsync.ext.ext_pulldb import pull_weight
+
+
+class MockPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def __getattr__(self, attr):
+        def queue(*args, **kwargs):
+            self.commands.append((attr, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [
+            getattr(self.redis, attr)(*args, **kwargs)
+            for attr, args, kwargs in self.commands
+        ]
+        self.commands = []
+        return results
+
 
 class MockRedis(mock.Mock):
     pull_data = None
+    pull_ids = []
     pull_keys = []
     pull_dict = {}
     longbox_data = None
@@ -15,7 +46,8 @@ class MockRedis(mock.Mock):
     def _load_pull_data(cls, test_data_filename):
         with open(test_data_filename) as json_file:
             cls.pull_data = json.load(json_file)
-        cls.pull_keys = ["pull:%s" % p["identifier"] for p in cls.pull_data]
+        cls.pull_ids = [p["identifier"] for p in cls.pull_data]
+        cls.pull_keys = ["pull:%s" % pull_id for pull_id in cls.pull_ids]
         cls.pull_dict = {
             key: json.dumps(value) for key, value in zip(
                 cls.pull_keys, cls.pull_data)
@@ -31,6 +63,17 @@ class MockRedis(mock.Mock):
             cls.longbox_data.items()
         }
 
+    @classmethod
+    def _zrange(cls, name, start, end, withscores=False):
+        weighted = sorted(
+            (pull_weight(pull), pull['identifier'])
+            for pull in cls.pull_data or [])
+        members = [
+            (pull_id, weight) for weight, pull_id in weighted[start:end + 1]]
+        if withscores:
+            return members
+        return [pull_id for pull_id, weight in members]
+
     @classmethod
     def reset_additions(cls):
         cls.additions = {}
@@ -39,9 +82,46 @@ class MockRedis(mock.Mock):
     def _set(cls, key, value):
         cls.additions[key] = value
 
+    @classmethod
+    def _delete(cls, *keys):
+        for key in keys:
+            cls.additions.pop(key, None)
+
+    @classmethod
+    def _zadd(cls, name, *pairs):
+        # StrictRedis.zadd from redis-py 2.x takes score, member pairs
+        if not pairs or len(pairs) % 2:
+            raise TypeError('zadd takes score, member pairs')
+        for score in pairs[::2]:
+            float(score)
+
+    @classmethod
+    def _exists(cls, key):
+        # Only negative cache entries are tracked, everything else exists
+        if key.startswith('gs:miss:'):
+            return key in cls.additions
+        return True
+
     fetch_unread = mock.Mock(side_effect=lambda: MockRedis.pull_data)
     get = mock.Mock(side_effect=lambda k: MockRedis.pull_dict.get(k))
     keys = mock.Mock(side_effect=lambda k: MockRedis.pull_keys)
-    set = mock.Mock(side_effect=lambda k, v: MockRedis._set(k, v))
+    mget = mock.Mock(
+        side_effect=lambda keys: [MockRedis.pull_dict.get(k) for k in keys])
+    scan_iter = mock.Mock(
+        side_effect=lambda *args, **kwargs: iter(MockRedis.pull_keys))
+    zrange = mock.Mock(
+        side_effect=lambda *args, **kwargs: MockRedis._zrange(*args, **kwargs))
+    sscan_iter = mock.Mock(
+        side_effect=lambda *args, **kwargs: iter(MockRedis.pull_ids))
+    set = mock.Mock(side_effect=lambda k, v, **kwargs: MockRedis._set(k, v))
     setex = mock.Mock(side_effect=lambda k, t, v: MockRedis._set(k, v))
+    delete = mock.Mock(side_effect=lambda *keys: MockRedis._delete(*keys))
+    exists = mock.Mock(side_effect=lambda k: MockRedis._exists(k))
+    zadd = mock.Mock(side_effect=lambda *args: MockRedis._zadd(*args))
     sismember = mock.Mock(side_effect=lambda s, k: k in MockRedis.seen_keys)
+    sdiff = mock.Mock(side_effect=lambda *args: [
+        pull_id for pull_id in MockRedis.pull_ids
+        if pull_id not in MockRedis.seen_keys])
+
+    def pipeline(self, *args, **kwargs):
+        return MockPipeline(self)
@@ -2,6 +2,7 @@ import os
 
 from cement.core import foundation, handler
 from cement.utils import test
+import mock
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -28,3 +29,17 @@ class GoogleAuthTest(test.CementTestCase):
     def ext_setup_test(self):
         self.app.setup()
         self.assertTrue(hasattr(self.app, 'google'))
+
+    def new_client_test(self):
+        self.app.setup()
+        credentials = mock.Mock(invalid=False)
+        store = mock.Mock()
+        store.get = mock.Mock(return_value=credentials)
+        with mock.patch.object(
+                type(self.app.google), 'credential_store',
+                new_callable=mock.PropertyMock, return_value=store):
+            with mock.patch('pullsync.ext.ext_google.tools.run_flow') as flow:
+                http_client = self.app.google.new_client()
+        # Stored credentials are used without running the flow
+        self.assertFalse(flow.called)
+        credentials.authorize.assert_called_once_with(http_client)
@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 
 from apiclient.http import HttpMock, HttpMockSequence
 from cement.core import foundation, handler
@@ -7,6 +9,9 @@ from cement.utils import test
 import mock
 from mock import call
 
+from pullsync.ext.ext_longbox import (
+    DISCOVERY_DOCUMENT, AdaptiveDownload, ContentIndex, Longbox)
+
 from tests.mocks import MockRedis
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
@@ -20,6 +25,12 @@ class TestApp(foundation.CementApp):
     class Meta:
         label = 'pullsync'
         argv = []
+        config_defaults = {
+            'data.longbox': {
+                # Avoid fetching the discovery document
+                'discovery_document': datafile('storage.json'),
+            },
+        }
         config_files = [datafile('longbox.conf')]
         extensions = [
             # interfaces must go first
@@ -34,22 +45,100 @@ class TestApp(foundation.CementApp):
 class PulldbTest(test.CementTestCase):
     app_class = TestApp
 
+    def setUp(self):
+        super(PulldbTest, self).setUp()
+        MockRedis.reset_additions()
+
     def ext_setup_test(self):
         self.app.setup()
         self.assertTrue(hasattr(self.app, 'longbox'))
 
+    def client_test(self):
+        self.app.setup()
+        self.app.longbox._http = HttpMockSequence([])
+        client = self.app.longbox.client
+        self.assertIs(self.app.longbox.client, client)
+        # Each thread builds its own service from the parsed document
+        clients = []
+        thread = threading.Thread(
+            target=lambda: clients.append(self.app.longbox.client))
+        thread.start()
+        thread.join()
+        self.assertIsNot(clients[0], client)
+        self.assertIs(
+            self.app.longbox.discovery_document,
+            self.app.longbox.discovery_document)
+        # The packaged document is used unless another one is configured
+        self.assertTrue(os.path.exists(DISCOVERY_DOCUMENT))
+        self.assertEqual(
+            Longbox.Meta.config_defaults['discovery_document'],
+            DISCOVERY_DOCUMENT)
+
     def check_prefix_test(self):
         self.app.setup()
         self.app.redis.client = MockRedis()
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1002.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1004.json')).read()),
         ])
         self.assertTrue(self.app.longbox.check_prefix(1002))
         self.assertFalse(self.app.longbox.check_prefix(1004))
 
+    def check_prefix_miss_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.redis.client.sismember = mock.Mock(return_value=False)
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 200}, open(datafile('storage_1004.json')).read()),
+            ({'status': 200}, open(datafile('storage_1002.json')).read()),
+        ])
+        self.assertFalse(self.app.longbox.check_prefix(1004))
+        self.assertIn('gs:miss:1004', MockRedis.additions)
+        # The miss is cached until it is forgotten
+        self.assertFalse(self.app.longbox.check_prefix(1004))
+        self.app.longbox.forget_miss(1004)
+        self.assertTrue(self.app.longbox.check_prefix(1004))
+
+    def list_prefix_retry_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': '503'}, ''),
+            ({'status': 200}, open(datafile('storage_1002.json')).read()),
+        ])
+        with mock.patch('pullsync.ext.ext_longbox.time.sleep') as sleep:
+            self.assertTrue(self.app.longbox.list_prefix(1002))
+        self.assertEqual(sleep.call_count, 1)
+
+    def file_details_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        stored = {'gs:file:1002': json.dumps([{'name': 'Test Issue 3.cbr'}])}
+        self.app.redis.client.sismember = mock.Mock(
+            side_effect=lambda key, pull_id: pull_id in (1001, 1002))
+        self.app.redis.client.get = mock.Mock(side_effect=stored.get)
+        self.app.redis.client.srem = mock.Mock()
+        details = self.app.longbox.file_details(['1000', 1001, 1002])
+        self.assertEqual(details, {1002: [{'name': 'Test Issue 3.cbr'}]})
+        # Expired file details are dropped from the seen set together
+        self.app.redis.client.srem.assert_called_once_with('gs:seen', 1001)
+
+    def iter_prefixes_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.longbox.file_details = mock.Mock(
+            side_effect=lambda pull_ids: {
+                int(pull_id): [{'name': 'cached'}] for pull_id in pull_ids
+                if pull_id != '1001'})
+        self.app.longbox.list_prefix = mock.Mock(return_value=None)
+        pulls = [{'id': str(pull_id)} for pull_id in range(1000, 1003)]
+        results = list(self.app.longbox.iter_prefixes(pulls, size=2))
+        self.assertEqual(
+            [bool(files) for pull, files in results], [True, False, True])
+        self.assertEqual(self.app.longbox.file_details.call_count, 2)
+        # Only the uncached pull is listed in the bucket
+        self.app.longbox.list_prefix.assert_called_once_with(1001)
+
     def scan_new_test(self):
         self.app.setup()
         self.app.redis.client = MockRedis()
@@ -73,15 +162,10 @@ class PulldbTest(test.CementTestCase):
              open(datafile('pull_data_1002.json')).read()),
         ])
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1000.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1001.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1002.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1003.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1004.json')).read()),
         ])
         self.app.longbox.scan(new=True)
@@ -109,15 +193,10 @@ class PulldbTest(test.CementTestCase):
             ({'status': 200}, open(datafile('fetch_unread.json')).read()),
         ])
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1000.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1001.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1002.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1003.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1004.json')).read()),
         ])
         self.app.longbox.scan(new=False)
@@ -129,3 +208,190 @@ class PulldbTest(test.CementTestCase):
             call('gs:seen', 1003), self.app.redis.client.sadd.call_args_list)
         self.assertNotIn(
             call('gs:seen', 1004), self.app.redis.client.sadd.call_args_list)
+
+    def fetch_file_resume_test(self):
+        self.app.setup()
+        item = {
+            'bucket': 'long-box',
+            'name': 'comics/e8/03/3e8/Test Issue 1.cbz',
+            'size': '11',
+            'md5Hash': 'XrY7u+Ae7tCTyyK7j1rNww==',
+        }
+        destination = os.path.join(self.tmp_dir, 'Test Issue 1 [0003e8].cbz')
+        with open(destination + '.part', 'w') as partial:
+            partial.write('hello')
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 500}, 'Server Error'),
+            ({'status': 206, 'content-range': 'bytes 5-10/11'}, ' world'),
+        ])
+        # The partial download is kept after an error
+        self.assertFalse(self.app.longbox.fetch_file(item, destination))
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual(os.path.getsize(destination + '.part'), 5)
+        self.assertTrue(self.app.longbox.fetch_file(item, destination))
+        self.assertFalse(os.path.exists(destination + '.part'))
+        with open(destination) as downloaded:
+            self.assertEqual(downloaded.read(), 'hello world')
+
+    def fetch_file_verify_test(self):
+        self.app.setup()
+        item = {
+            'bucket': 'long-box',
+            'name': 'comics/e8/03/3e8/Test Issue 1.cbz',
+            'size': '11',
+            'md5Hash': 'eOjYd4CY9ceez7BrZ7hfcA==',
+        }
+        destination = os.path.join(self.tmp_dir, 'Test Issue 1 [0003e8].cbz')
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 206, 'content-range': 'bytes 0-10/11'},
+             'hello world'),
+        ])
+        self.assertFalse(self.app.longbox.fetch_file(item, destination))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def adaptive_download_test(self):
+        request = mock.Mock(uri='http://example.com/media')
+        request.http = HttpMockSequence([
+            ({'status': 206, 'content-range': 'bytes 0-3/12'}, 'abcd'),
+            ({'status': 206, 'content-range': 'bytes 4-7/12'}, 'efgh'),
+            ({'status': 206, 'content-range': 'bytes 8-11/12'}, 'ijkl'),
+        ])
+        fh = mock.Mock()
+        downloader = AdaptiveDownload(
+            fh, request, min_chunksize=2, max_chunksize=16, chunksize=4)
+        with mock.patch('time.time', side_effect=[0, 1, 1, 1.25, 1.25, 10]):
+            # Fast chunks grow the chunk size up to double each time
+            downloader.next_chunk()
+            self.assertEqual(downloader._chunksize, 8)
+            downloader.next_chunk()
+            self.assertEqual(downloader._chunksize, 16)
+            # A slow chunk shrinks it by at most half
+            status, done = downloader.next_chunk()
+            self.assertEqual(downloader._chunksize, 8)
+        self.assertTrue(done)
+        self.assertEqual(downloader.received, 12)
+        self.assertEqual(downloader.elapsed, 10)
+
+    def fetch_file_local_copy_test(self):
+        self.app.setup()
+        self.app.longbox.content_index = ContentIndex(
+            os.path.join(self.tmp_dir, 'content_index.json'))
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.app.config.set(
+            self.app.longbox._meta.config_section, 'cache_dir', cache_dir)
+        item = {
+            'bucket': 'long-box',
+            'name': 'comics/e8/03/3e8/Test Issue 1.cbz',
+            'size': '11',
+            'md5Hash': 'XrY7u+Ae7tCTyyK7j1rNww==',
+        }
+        first = os.path.join(self.tmp_dir, 'first.cbz')
+        second = os.path.join(self.tmp_dir, 'second.cbz')
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 206, 'content-range': 'bytes 0-10/11'},
+             'hello world'),
+        ])
+        self.assertTrue(
+            self.app.longbox.fetch_file(item, first, pull_id=1000))
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, 'first.cbz')))
+        # Later fetches are served from the local copies
+        os.unlink(first)
+        self.assertTrue(
+            self.app.longbox.fetch_file(item, second, pull_id=1000))
+        with open(second) as local_copy:
+            self.assertEqual(local_copy.read(), 'hello world')
+        # A new version of the object isn't served from the old copies
+        index = ContentIndex(os.path.join(self.tmp_dir, 'content_index.json'))
+        self.assertEqual(len(index.entries['1000']['files']), 2)
+        item['md5Hash'] = 'eOjYd4CY9ceez7BrZ7hfcA=='
+        self.assertEqual(index.find(1000, item), None)
+        self.assertEqual(index.entries, {})
+
+    def prune_cache_test(self):
+        self.app.setup()
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        self.app.config.set(
+            self.app.longbox._meta.config_section, 'cache_max_size', 25)
+        for age, name in enumerate(['newest', 'newer', 'older', 'oldest']):
+            path = os.path.join(cache_dir, name + '.cbz')
+            with open(path, 'w') as cached:
+                cached.write('x' * 10)
+            os.utime(path, (time.time() - age * 60,) * 2)
+        # The oldest files go first, but never the one just cached
+        self.app.longbox.prune_cache(
+            cache_dir, keep=os.path.join(cache_dir, 'oldest.cbz'))
+        self.assertEqual(
+            sorted(os.listdir(cache_dir)), ['newest.cbz', 'oldest.cbz'])
+        self.app.config.set(
+            self.app.longbox._meta.config_section, 'cache_max_size', 0)
+        self.app.longbox.prune_cache(cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def build_index_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.redis.client.smembers = mock.Mock(return_value={'1002'})
+        self.app.redis.client.llen = mock.Mock(return_value=2)
+        items = [
+            {'bucket': 'long-box', 'name': 'comics/e8/03/3e8/Issue 1.cbr'},
+            {'bucket': 'long-box', 'name': 'comics/e8/03/3e8/Issue 1.cbz'},
+            {'bucket': 'long-box', 'name': 'comics/e9/03/3e9/Issue 2.cbz'},
+            {'bucket': 'long-box', 'name': 'comics/README'},
+        ]
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 200}, json.dumps(
+                {'items': items[:2], 'nextPageToken': 'abc'})),
+            ({'status': 200}, json.dumps({'items': items[2:]})),
+        ])
+        index = self.app.longbox.build_index()
+        self.assertEqual(index, {1000: items[:2], 1001: items[2:3]})
+        self.app.redis.client.sadd.assert_has_calls(
+            [call('gs:seen', 1000), call('gs:seen', 1001)], any_order=True)
+        self.app.redis.client.srem.assert_called_once_with('gs:seen', 1002)
+        self.app.redis.client.delete.assert_any_call('gs:file:1002')
+        self.app.redis.client.delete.assert_any_call('gs:miss:1000')
+        self.assertEqual(
+            json.loads(MockRedis.additions['gs:file:1000']), items[:2])
+        # Uploads logged before the listing are dropped from the log
+        self.app.redis.client.ltrim.assert_called_once_with(
+            'gs:uploads', 2, -1)
+
+    def record_upload_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.redis.client.rpush = mock.Mock()
+        self.app.redis.client.ltrim = mock.Mock()
+        # Nothing is logged until an index has been built
+        self.app.redis.client.hget = mock.Mock(return_value=None)
+        self.app.longbox.record_upload(1000)
+        self.assertFalse(self.app.redis.client.rpush.called)
+        self.app.redis.client.hget = mock.Mock(return_value=str(time.time()))
+        self.app.longbox.record_upload(1000)
+        self.app.redis.client.rpush.assert_called_once_with(
+            'gs:uploads', 1000)
+        self.app.redis.client.ltrim.assert_called_once_with(
+            'gs:uploads', -10000, -1)
+
+    def update_index_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.redis.client.hget = mock.Mock(
+            return_value=str(time.time() - 3600))
+        self.app.redis.client.lrange = mock.Mock(return_value=['1000', '1001'])
+        self.app.longbox.build_index = mock.Mock()
+        item = {
+            'bucket': 'long-box', 'name': 'comics/e8/03/3e8/Issue 1.cbz'}
+        self.app.longbox._http = HttpMockSequence([
+            ({'status': 200}, json.dumps({'items': [item]})),
+            ({'status': 200}, json.dumps({})),
+        ])
+        # Only the pulls in the upload log are listed
+        index = self.app.longbox.update_index()
+        self.assertFalse(self.app.longbox.build_index.called)
+        self.assertEqual(index, {1000: [item]})
+        self.app.redis.client.delete.assert_any_call('gs:uploads')
+        self.app.redis.client.sadd.assert_called_with('gs:seen', 1000)
+        self.app.redis.client.srem.assert_called_with('gs:seen', 1001)
+        self.app.longbox.update_index(rebuild=True)
+        self.assertTrue(self.app.longbox.build_index.called)
@@ -42,6 +42,25 @@ class UploadPluginTest(test.CementTestCase):
             self.app.match.normalise_name('The Walking Dead #012 (2014)'),
             ('walking dead #12', '12'),
         )
+        self.assertEqual(
+            self.app.match.normalise_name(
+                'Trinity of Sin - The Phantom Stranger 005 (2014).cbr'),
+            self.app.match.normalise_name('The Phantom Stranger 5'),
+        )
+
+    def normalise_many_test(self):
+        self.app.setup()
+        names = [
+            'The Walking Dead #012 (2014)',
+            'Abe Sapien 012 - Dark and Terrible (2014).cbz',
+            'The Walking Dead #012 (2014)',
+        ]
+        self.assertEqual(
+            self.app.match.normalise_many(names),
+            [self.app.match.normalise_name(name) for name in names],
+        )
+        self.assertEqual(
+            self.app.match.normalise_many(names)[1], ('abe sapien 12', '12'))
 
     def weighted_distance_test(self):
         self.app.setup()
@@ -50,6 +69,22 @@ class UploadPluginTest(test.CementTestCase):
         self.assertGreater(
             self.app.match.weighted_distance('spider-man', 'supergirl'), 0.5)
 
+    def weighted_distance_threshold_test(self):
+        self.app.setup()
+        self.assertEqual(self.app.match.weighted_distance(
+            'superman 1', 'superman 1', threshold=0.2), 0)
+        self.assertEqual(self.app.match.weighted_distance(
+            'superman 1', 'supermen 1', threshold=0.2), 0.1)
+        # rejected on length alone
+        self.assertEqual(self.app.match.weighted_distance(
+            'superman 1', 'superman unchained 1', threshold=0.2),
+            float('inf'))
+        self.assertEqual(self.app.match.weighted_distance(
+            'spider-man', 'supergirl', threshold=0.2), float('inf'))
+        # distances on the threshold are not matches
+        self.assertEqual(self.app.match.weighted_distance(
+            'abcde', 'abcdf', threshold=0.2), float('inf'))
+
     def compare_pull_test(self):
         self.app.setup()
         results = json.load(open(datafile('fetch_new.json')))
@@ -80,3 +115,134 @@ class UploadPluginTest(test.CementTestCase):
         matches = sorted(list(self.app.match.compare_pull(
             (('test issue 5', '5'), 'dummy_path'), [])))
         self.assertListEqual(matches, [])
+
+    def index_pulls_test(self):
+        self.app.setup()
+        results = json.load(open(datafile('fetch_new.json')))
+        pulls = [entry['pull'] for entry in results['results']][:2]
+        index = self.app.match.index_pulls(pulls)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(
+            list(index)[0], (pulls[0], ('test issue 1', '1')))
+
+        cache = mock.MagicMock()
+        cache.mget = mock.Mock(
+            return_value=[None, json.dumps(['cached issue 2', '2'])])
+        pipe = cache.pipeline.return_value.__enter__.return_value
+        pipe.execute = mock.Mock(return_value=[3600])
+        index = list(self.app.match.index_pulls(pulls, cache=cache))
+        self.assertEqual(index[0][1], ('test issue 1', '1'))
+        self.assertEqual(index[1][1], ('cached issue 2', '2'))
+        pipe.ttl.assert_called_once_with('pull:%s' % pulls[0]['identifier'])
+        self.assertEqual(pipe.setex.call_count, 1)
+        self.assertEqual(pipe.setex.call_args[0][1], 3600)
+
+        # Names normalised with other rules are not reused
+        key = pipe.setex.call_args[0][0]
+        self.app.match.normaliser = ext_matcher.NameNormaliser(
+            ext_matcher.NORMALISE_RULES + [[(r'issue', 'number')]])
+        self.assertNotEqual(self.app.match._index_key(pulls[0]), key)
+
+    def compare_pull_blocking_test(self):
+        self.app.setup()
+        results = json.load(open(datafile('fetch_new.json')))
+        pulls = self.app.match.index_pulls(
+            [entry['pull'] for entry in results['results']])
+
+        matches = list(self.app.match.compare_pull(
+            ('.', 'Test Issue 1 (2014).cbr'), pulls, blocking=True))
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0][2]['id'], '1000')
+
+        matches = list(self.app.match.compare_pull(
+            ('.', 'Test Issue 12 (2014).cbr'), pulls, blocking=True))
+        self.assertEqual(len(matches), len(pulls))
+        self.assertTrue(all(match[0] for match in matches))
+
+        # Pulls with the same issue are scored even with no shared word
+        matches = list(self.app.match.compare_pull(
+            ('.', 'dummy 5'), pulls, blocking=True))
+        self.assertEqual(len(matches), 1)
+        self.assertFalse(matches[0][0])
+
+        matches = list(self.app.match.compare_pull(
+            ('.', 'dummy 12'), pulls, blocking=True))
+        self.assertListEqual(matches, [])
+
+    def blocking_joined_words_test(self):
+        self.app.setup()
+        pulls = self.app.match.index_pulls([
+            {'identifier': '1000', 'name': 'X-Men 5'},
+            {'identifier': '1001', 'name': 'Spider-Man 5'},
+            {'identifier': '1002', 'name': 'X-Force 6'},
+        ])
+        # Pulls with the same issue are scored even without a shared word
+        self.assertEqual(pulls.plausible('xmen 5', '5'), [0, 1])
+        for candidate in ('XMen 005 (2014).cbr', 'X Men 5.cbz'):
+            blocked = self.app.match.score_matrix(
+                [('.', candidate)], pulls, 0.2)
+            unblocked = self.app.match.score_matrix(
+                [('.', candidate)], pulls, 0.2, blocking=False)
+            self.assertEqual(blocked.best_match(0)[2]['identifier'], '1000')
+            self.assertEqual(
+                blocked.best_match(0), unblocked.best_match(0))
+
+    def best_matches_test(self):
+        self.app.setup()
+        results = json.load(open(datafile('fetch_new.json')))
+        pulls = [entry['pull'] for entry in results['results']]
+        candidates = [
+            ('.', 'Test Issue %d (2014).cbr' % issue)
+            for issue in range(1, 8)
+        ] + [('.', 'Unrelated 1.cbz')]
+        serial = list(self.app.match.best_matches(candidates, pulls, 0.2))
+        parallel = list(self.app.match.best_matches(
+            candidates, pulls, 0.2, jobs=2))
+        self.assertEqual(serial, parallel)
+        self.assertEqual([match[0] for match in serial], candidates[:7])
+        self.assertEqual(serial[0][1][2]['id'], '1000')
+        self.assertTrue(serial[0][2])
+        self.assertTrue(serial[6][1][0])
+        self.assertFalse(serial[6][2])
+
+    def best_matches_assign_test(self):
+        self.app.setup()
+        results = json.load(open(datafile('fetch_new.json')))
+        pulls = [entry['pull'] for entry in results['results']]
+        candidates = [
+            ('.', 'Test Issue 1 (2014) (digital).cbr'),
+            ('.', 'Test Issue 1.cbr'),
+            ('.', 'Test Issue 2.cbr'),
+        ]
+        greedy = list(self.app.match.best_matches(candidates, pulls, 0.2))
+        self.assertEqual([match[2] for match in greedy], [True, True, True])
+        assigned = list(self.app.match.best_matches(
+            candidates, pulls, 0.2, assign=True))
+        self.assertEqual(
+            [match[2] for match in assigned], [True, False, True])
+        self.assertEqual(assigned[0][1][2]['id'], '1000')
+        self.assertEqual(assigned[2][1][2]['id'], '1001')
+
+    def score_matrix_test(self):
+        self.app.setup()
+        results = json.load(open(datafile('fetch_new.json')))
+        pulls = [entry['pull'] for entry in results['results']]
+        candidates = [
+            ('.', 'Test Issue 2 (2014).cbr'),
+            ('.', 'Test Issue 9 (2014).cbr'),
+            ('.', 'Unrelated 1.cbz'),
+        ]
+        matrix = self.app.match.score_matrix(candidates, pulls, 0.2)
+        self.assertEqual(matrix.shape, (3, len(pulls)))
+        self.assertEqual(len(matrix.scores), 3 * len(pulls))
+        self.assertEqual(matrix.best[0], 1)
+        self.assertEqual(matrix.scores[1], 0)
+        self.assertEqual(matrix.mismatch[1], 0)
+        self.assertEqual(matrix.mismatch[0], 1)
+        self.assertEqual(matrix.scores[0], float('inf'))
+        self.assertEqual(matrix.best[2], -1)
+        self.assertEqual(
+            matrix.best_match(0),
+            list(self.app.match.compare_pull(candidates[0], pulls[1:2]))[0])
+        self.assertTrue(matrix.best_match(1)[0])
+        self.assertIsNone(matrix.best_match(2))
@@ -8,6 +8,9 @@ from cement.utils import test
 import mock
 
 from pullsync.ext.ext_pulldb import FetchError, UpdateError
+from pullsync.ext.ext_pulldb import PullJournal
+
+from tests.mocks import MockRedis
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -27,6 +30,7 @@ class TestApp(foundation.CementApp):
             'pullsync.ext.interfaces',
             'pullsync.ext.ext_google',
             'pullsync.ext.ext_pulldb',
+            'pullsync.ext.ext_redis',
         ]
 
 
@@ -37,10 +41,12 @@ class PulldbTest(test.CementTestCase):
         self.app.setup()
         with open(os.path.join(TEST_DATA_DIR, 'unread.json')) as json_file:
             unread = json.load(json_file)
-        self.app.pulldb.fetch_page = mock.Mock(return_value=unread)
+        self.app.redis.client = MockRedis()
+        self.app.pulldb._request_page = mock.Mock(
+            return_value=json.dumps(unread))
         self.assertEqual(len(unread['results']), 100)
-        results = self.app.pulldb.fetch_unread()
-        self.app.pulldb.fetch_page.assert_called_with(
+        results = list(self.app.pulldb.fetch_unread())
+        self.app.pulldb._request_page.assert_called_with(
             '/api/pulls/list/unread', cursor=None
         )
         self.assertEqual(len(results), 100)
@@ -51,16 +57,125 @@ class PulldbTest(test.CementTestCase):
         self.app.setup()
         with open(os.path.join(TEST_DATA_DIR, 'fetch_new.json')) as json_file:
             unread = json.load(json_file)
-        self.app.pulldb.fetch_page = mock.Mock(return_value=unread)
+        self.app.pulldb._request_page = mock.Mock(
+            return_value=json.dumps(unread))
         self.assertEqual(len(unread['results']), 5)
-        results = self.app.pulldb.fetch_new()
-        self.app.pulldb.fetch_page.assert_called_with(
-            '/api/pulls/list/new', cursor=None, cache=False
+        results = list(self.app.pulldb.fetch_new())
+        self.app.pulldb._request_page.assert_called_with(
+            '/api/pulls/list/new', cursor=None
         )
         self.assertEqual(len(results), 5)
         for pull in results:
             self.assertTrue('issue_id' in pull)
 
+    def iter_pages_test(self):
+        self.app.setup()
+        pages = [
+            {'results': [], 'more_results': True, 'next_page': 'abc'},
+            {'results': [], 'more_results': False},
+        ]
+        self.app.pulldb._request_page = mock.Mock(side_effect=[
+            json.dumps(page) for page in pages])
+        results = list(self.app.pulldb.iter_pages(
+            '/api/pulls/list/new', cache=False))
+        self.assertEqual(results, pages)
+        self.app.pulldb._request_page.assert_called_with(
+            '/api/pulls/list/new', cursor='abc')
+
+    def iter_pages_error_test(self):
+        self.app.setup()
+        page = {'results': [], 'more_results': True, 'next_page': 'abc'}
+        self.app.pulldb._request_page = mock.Mock(side_effect=[
+            json.dumps(page), FetchError('Failed')])
+        pages = self.app.pulldb.iter_pages('/api/pulls/list/new', cache=False)
+        self.assertEqual(next(pages), page)
+        with self.assertRaises(FetchError):
+            next(pages)
+
+    def iter_pages_journal_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.pulldb.data_dir = self.tmp_dir
+        with open(os.path.join(TEST_DATA_DIR, 'unread.json')) as json_file:
+            content = json_file.read()
+        page = json.loads(content)
+        page['more_results'] = False
+        self.app.pulldb._request_page = mock.Mock(
+            return_value=json.dumps(page, indent=2))
+        list(self.app.pulldb.iter_pages('/api/pulls/list/unread'))
+        journal = PullJournal(self.tmp_dir)
+        index = journal.load()
+        self.assertEqual(len(index['pulls']), 100)
+        self.assertEqual(index['ttl'], 86400)
+        lines = list(journal.read())
+        self.assertEqual(len(lines), 100)
+        for result, line in zip(page['results'], lines):
+            self.assertEqual(json.loads(line), result['pull'])
+        pull = page['results'][10]['pull']
+        self.assertEqual(json.loads(journal.get(pull['id'])), pull)
+        self.assertEqual(journal.get('missing'), None)
+
+    def journal_abort_test(self):
+        journal = PullJournal(self.tmp_dir)
+        journal.start()
+        journal.append([({'id': '1'}, '{"id": "1"}')])
+        journal.commit()
+        first = journal.load()
+        journal.start()
+        journal.append([({'id': '2'}, '{"id": "2"}')])
+        journal.abort()
+        self.assertEqual(journal.load(), first)
+        self.assertEqual(list(journal.read()), ['{"id": "1"}'])
+        self.assertItemsEqual(os.listdir(self.tmp_dir), [
+            first['journal'], PullJournal.index_name])
+
+    def restore_snapshot_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        self.app.pulldb.data_dir = self.tmp_dir
+        self.assertEqual(self.app.pulldb.restore_snapshot(), 0)
+        journal = PullJournal(self.tmp_dir)
+        journal.start()
+        journal.append([
+            ({'id': '1'}, '{"id": "1"}'),
+            ({'id': '2', 'stream_id': 'dc', 'weight': '0.5'},
+             '{"id": "2", "stream_id": "dc", "weight": "0.5"}'),
+        ])
+        journal.commit()
+        MockRedis.reset_additions()
+        self.assertEqual(self.app.pulldb.restore_snapshot(), 2)
+        self.assertEqual(MockRedis.additions, {
+            'pull:1': '{"id": "1"}',
+            'pull:2': '{"id": "2", "stream_id": "dc", "weight": "0.5"}',
+        })
+        self.assertTrue(MockRedis.set.call_args[1]['nx'])
+        self.assertTrue(
+            0 < MockRedis.set.call_args[1]['ex'] <= 86400)
+        self.app.redis.client.zadd.assert_called_with(
+            'pulls:weight', 0.5, '2')
+
+    def refresh_pulls_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+
+        def request(url):
+            pull_id = url.rsplit('/', 2)[-2]
+            if pull_id == '1003':
+                return mock.Mock(status=200), '{"results": []}'
+            with open(datafile('pull_data_%s.json' % pull_id)) as data:
+                return mock.Mock(status=200), data.read()
+
+        http_mock = mock.Mock()
+        http_mock.request = mock.Mock(side_effect=request)
+        self.app.google.new_client = mock.Mock(return_value=http_mock)
+        self.app.redis.client.setex.reset_mock()
+        pulls = self.app.pulldb.refresh_pulls([1000, 1003, 1001, 1002])
+        self.assertEqual(
+            [pull and pull['id'] for pull in pulls],
+            ['1000', None, '1001', '1002'])
+        self.assertEqual(self.app.redis.client.setex.call_count, 3)
+        self.assertEqual(self.app.pulldb.refresh_pulls([]), [])
+
     def pull_new_test(self):
         self.app.setup()
         self.app.google._http = HttpMockSequence([
@@ -95,3 +210,87 @@ class PulldbTest(test.CementTestCase):
         print list(request_args)
         data = json.loads(request_args[1]['body'])
         self.assertEqual(data['pull'][0], "1000")
+
+    def list_unread_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+        # pull 1001 has expired but is still in the index
+        del MockRedis.pull_dict['pull:1001']
+        results = list(self.app.pulldb.list_unread())
+        self.assertEqual(len(results), len(MockRedis.pull_ids) - 1)
+        self.assertNotIn('1001', [pull['id'] for pull in results])
+        self.app.redis.client.srem.assert_called_once_with(
+            'pulls:unread', '1001')
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+
+    def rebuild_index_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+        MockRedis.reset_additions()
+        # A pull cached before the first rebuild leaves a partial index
+        self.app.redis.client.exists = mock.Mock(
+            side_effect=lambda key: key in MockRedis.additions or (
+                key == 'pulls:unread'))
+        self.app.redis.client.sadd = mock.Mock()
+        list(self.app.pulldb.list_unread())
+        self.assertEqual(
+            sorted(args[0][1] for args in
+                   self.app.redis.client.sadd.call_args_list),
+            sorted(MockRedis.pull_ids))
+        self.assertIn('pulls:indexed', MockRedis.additions)
+        # The index is only rebuilt once
+        self.app.redis.client.sadd.reset_mock()
+        list(self.app.pulldb.list_unseen())
+        self.assertFalse(self.app.redis.client.sadd.called)
+        MockRedis.reset_additions()
+
+    def refresh_unread_unindexed_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+        MockRedis.reset_additions()
+        indexed = set()
+        # Only pull:* keys exist, the unread index has never been built
+        self.app.redis.client.exists = mock.Mock(
+            side_effect=lambda key: key in MockRedis.additions)
+        self.app.redis.client.sadd = mock.Mock(
+            side_effect=lambda name, pull_id: indexed.add(pull_id))
+        self.app.redis.client.sscan_iter = mock.Mock(
+            side_effect=lambda *args, **kwargs: iter(sorted(indexed)))
+        self.app.redis.client.expire = mock.Mock()
+        self.app.pulldb.iter_pages = mock.Mock(return_value=iter([]))
+        self.app.pulldb.refresh_unread()
+        self.assertEqual(indexed, set(MockRedis.pull_ids))
+        self.assertEqual(
+            sorted(args[0][0] for args in
+                   self.app.redis.client.expire.call_args_list),
+            sorted('pull:%s' % pull_id for pull_id in MockRedis.pull_ids))
+        MockRedis.reset_additions()
+
+    def iter_by_weight_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+        results = list(self.app.pulldb.iter_by_weight())
+        self.assertEqual(len(results), len(MockRedis.pull_ids))
+        self.assertEqual(results, sorted(results))
+        for weight, pull_id, pull in results:
+            self.assertEqual(pull_id, pull['id'])
+        results = list(self.app.pulldb.iter_by_weight(limit=2))
+        self.assertEqual(len(results), 2)
+
+    def list_unseen_test(self):
+        self.app.setup()
+        self.app.redis.client = MockRedis()
+        MockRedis._load_pull_data(datafile('list_unread.json'))
+        MockRedis._load_longbox_data(datafile('new_stored.json'))
+        results = [pull['id'] for pull in self.app.pulldb.list_unseen()]
+        self.assertEqual(
+            sorted(results),
+            sorted(set(MockRedis.pull_ids) - set(MockRedis.seen_keys)))
+        self.assertEqual(
+            self.app.pulldb.seen_status(MockRedis.pull_ids),
+            [pull_id in MockRedis.seen_keys
+             for pull_id in MockRedis.pull_ids])
@@ -2,6 +2,7 @@ import os
 
 from cement.core import foundation, handler
 from cement.utils import test
+import mock
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -28,3 +29,13 @@ class RedisCacheTest(test.CementTestCase):
     def ext_setup_test(self):
         self.app.setup()
         self.assertTrue(hasattr(self.app, 'redis'))
+
+    def multi_get_test(self):
+        self.app.setup()
+        values = dict(('key:%d' % index, index) for index in range(5))
+        self.app.redis.client = mock.Mock()
+        self.app.redis.client.mget = mock.Mock(
+            side_effect=lambda keys: [values[key] for key in keys])
+        results = list(self.app.redis.multi_get(sorted(values), size=2))
+        self.assertEqual(results, sorted(values.items()))
+        self.assertEqual(self.app.redis.client.mget.call_count, 3)
@@ -1,5 +1,6 @@
 import json
 import os
+import socket
 
 from apiclient.http import HttpMockSequence
 from cement.core import foundation, handler
@@ -58,6 +59,92 @@ class SyncPluginTest(test.CementTestCase):
         for pull_tuple in sync_handler.weighted_pulls():
             self.assertIsInstance(pull_tuple, tuple)
 
+    def exportable_items_test(self):
+        self.app.setup()
+        MockRedis._load_pull_data(datafile('sync_unread.json'))
+        self.app.redis.client = MockRedis()
+        self.app._parsed_args = mock.Mock(count=2)
+        streams = {'1000': 'dc', '1001': 'dc', '1002': 'marvel'}
+
+        def refresh_pulls(pull_ids):
+            pulls = []
+            for pull_id in pull_ids:
+                pull = dict(MockRedis.pull_data[pull_id - 1000])
+                pull['stream_id'] = streams.get(pull['id'])
+                pulls.append(pull)
+            return pulls
+
+        self.app.pulldb.refresh_pulls = mock.Mock(side_effect=refresh_pulls)
+        self.app.longbox.file_details = mock.Mock(
+            side_effect=lambda pull_ids: {
+                pull_id: [{'name': 'comics/%x.cbz' % pull_id}]
+                for pull_id in pull_ids if pull_id != 1000})
+        self.app.longbox.list_prefix = mock.Mock(return_value=None)
+        sync_handler = handler.get('controller', 'sync')()
+        sync_handler.app = self.app
+        items = list(sync_handler.exportable_items())
+        # 1000 is missing from the longbox which stalls 1001 in the same
+        # stream and 1003 has no stream
+        self.assertEqual([item['id'] for item, files in items], ['1002'])
+        # Only the pull with no cached files goes to the bucket
+        self.app.longbox.list_prefix.assert_called_once_with(1000)
+        self.app.pulldb.refresh_pulls.assert_has_calls([
+            mock.call([1000, 1001]),
+            mock.call([1002, 1003]),
+            mock.call([1004]),
+        ])
+
+    def parallel_fetch_test(self):
+        self.app.setup()
+        self.app._parsed_args = mock.Mock(
+            destination=self.tmp_dir, strict=True, parallel=3, retries=1)
+        pulls = [
+            {'identifier': str(pull_id), 'name': 'Test Issue %d' % pull_id,
+             'weight': '0.5'}
+            for pull_id in range(1000, 1005)
+        ]
+        sync_handler = handler.get('controller', 'sync')()
+        sync_handler.app = self.app
+        sync_handler.exportable_items = mock.Mock(return_value=iter(
+            (pull, [{
+                'name': 'comics/%x.cbz' % int(pull['identifier']),
+                'contentType': 'application/x-cbz',
+            }]) for pull in pulls))
+        attempts = {}
+
+        def fetch_file(source, destination, pull_id=None):
+            # The first attempt of every other file fails
+            attempts[source['name']] = attempts.get(source['name'], 0) + 1
+            return int(source['name'][-5], 16) % 2 == 0 or (
+                attempts[source['name']] > 1)
+
+        self.app.longbox.fetch_file = mock.Mock(side_effect=fetch_file)
+        sync_handler.default()
+        self.assertEqual(self.app.longbox.fetch_file.call_count, 7)
+        self.assertEqual(sorted(attempts.values()), [1, 1, 1, 2, 2])
+        destinations = sorted(
+            call[0][1] for call in self.app.longbox.fetch_file.call_args_list)
+        self.assertEqual(destinations[0], os.path.join(
+            self.tmp_dir, 'Test Issue 1000 [0003e8].cbz'))
+
+    def fetch_file_dropped_connection_test(self):
+        self.app.setup()
+        self.app._parsed_args = mock.Mock(retries=2)
+        sync_handler = handler.get('controller', 'sync')()
+        sync_handler.app = self.app
+        source = {'name': 'comics/3e8.cbz'}
+        # A dropped connection is retried like a failed download
+        self.app.longbox.fetch_file = mock.Mock(side_effect=[
+            socket.error(104, 'Connection reset by peer'),
+            IOError('Truncated read'),
+            True,
+        ])
+        progress = mock.Mock()
+        self.assertTrue(sync_handler.fetch_file(
+            1000, source, os.path.join(self.tmp_dir, 'issue.cbz'), progress))
+        self.assertEqual(self.app.longbox.fetch_file.call_count, 3)
+        progress.done.assert_called_once_with(source['name'])
+
     def blah(self):
         # setup mockredis
         new_items = self.app.pulldb.list_unread()
@@ -26,6 +26,12 @@ class TestApp(foundation.CementApp):
     class Meta:
         label = 'pullsync'
         argv = []
+        config_defaults = {
+            'data.longbox': {
+                # Avoid fetching the discovery document
+                'discovery_document': datafile('storage.json'),
+            },
+        }
         config_files = [
             os.path.join(TEST_DATA_DIR, 'upload.conf')
         ]
@@ -44,6 +50,10 @@ class TestApp(foundation.CementApp):
 class UploadPluginTest(test.CementTestCase):
     app_class = TestApp
 
+    def setUp(self):
+        super(UploadPluginTest, self).setUp()
+        MockRedis.reset_additions()
+
     def load_plugin_test(self):
         self.app.setup()
         self.assertIn('upload', self.app.plugin._loaded_plugins)
@@ -60,16 +70,20 @@ class UploadPluginTest(test.CementTestCase):
             key: json.dumps(value) for key, value in zip(test_keys, unread)
         }
         client = mock.Mock()
-        client.keys = mock.Mock(return_value=test_keys)
-        client.get = mock.Mock(
-            side_effect=lambda k: test_dict[k]
+        client.sscan_iter = mock.Mock(
+            side_effect=lambda *args, **kwargs: iter(
+                [p["identifier"] for p in unread]))
+        client.mget = mock.Mock(
+            side_effect=lambda keys: [test_dict[k] for k in keys]
         )
         self.app.redis.client = client
         self.app.pulldb.fetch_unread = mock.Mock(return_value=unread)
-        client.sismember = mock.Mock(return_value=True)
+        client.sdiff = mock.Mock(return_value=[])
         results = list(plugin.identify_unseen(check_type='unseen'))
         self.assertEqual(len(results), 0)
-        client.sismember = mock.Mock(return_value=False)
+        client.sdiff.assert_called_with('pulls:unread', 'gs:seen')
+        client.sdiff = mock.Mock(
+            return_value=[p["identifier"] for p in unread])
         results = list(plugin.identify_unseen(check_type='unseen'))
         self.assertEqual(len(results), len(test_keys))
 
@@ -95,7 +109,6 @@ class UploadPluginTest(test.CementTestCase):
                 datafile('pull_fetch_1000.json')).read()),
         ])
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1000.json')).read()),
         ])
         candidate = ('.', 'Test Issue 1 (2014).cbr')
@@ -112,7 +125,6 @@ class UploadPluginTest(test.CementTestCase):
         plugin.app = self.app
         self.app.redis.client = MockRedis()
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_nomatch.json')).read()),
         ])
         candidate = ('.', 'Test Issue 1 (2014).cbr')
@@ -141,20 +153,20 @@ class UploadPluginTest(test.CementTestCase):
                 datafile('pull_fetch_1000.json')).read()),
         ])
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_nomatch.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1000.json')).read()),
         ])
         candidate = ('.', 'Test Issue 1 (2014).cbr')
         with open(datafile('pull_data_1000.json')) as pull_data:
             best_match = json.load(pull_data)
 
-        # cases: unread pull, no file, transfer good
+        # cases: unread pull, no file, transfer good, longbox indexed
         upload.subprocess.check_call = mock.Mock()
+        self.app.redis.client.hget = mock.Mock(return_value='1408145935.9')
         plugin.commit_file(best_match, candidate)
 
         self.app.redis.client.sadd.assert_called_with('gs:seen', 1000)
+        self.app.redis.client.rpush.assert_called_with('gs:uploads', 1000)
         self.assertNotIn('pull:1000', self.app.redis.client.additions)
 
     def commit_new_test(self):
@@ -163,7 +175,6 @@ class UploadPluginTest(test.CementTestCase):
         plugin.app = self.app
         self.app.redis.client = MockRedis()
         self.app.google._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1001.json')).read()),
             ({'status': 200}, open(
                 datafile('pull_update_pull_1001.json')).read()),
@@ -176,7 +187,8 @@ class UploadPluginTest(test.CementTestCase):
         # cases: new pull, file exists
         upload.subprocess.check_call = mock.Mock()
         plugin.commit_file(best_match, candidate)
-        self.app.redis.client.sadd.assert_called_with('gs:seen', 1001)
+        self.app.redis.client.sadd.assert_any_call('gs:seen', 1001)
+        self.app.redis.client.sadd.assert_any_call('pulls:unread', u'1001')
         self.assertIn('pull:1001', self.app.redis.client.additions)
 
     def commit_new_nomatch_test(self):
@@ -191,9 +203,7 @@ class UploadPluginTest(test.CementTestCase):
                 datafile('pull_fetch_1001.json')).read()),
         ])
         self.app.longbox._http = HttpMockSequence([
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_nomatch.json')).read()),
-            ({'status': 200}, open(datafile('storage.json')).read()),
             ({'status': 200}, open(datafile('storage_1001.json')).read()),
         ])
         candidate = ('.', 'Test Issue 2 (2014).cbr')